@@ -0,0 +1,700 @@
+'''
+Offline benchmark for the zmnotify Appdaemon app.
+
+Runs ZmEventNotifier, HASensor and ZmMonitor against a local stub Zoneminder HTTP server
+and a fake Appdaemon hass.Hass host, replays a synthetic or recorded stream of MQTT sensor
+states and reports alerts/sec and the p50/p99 time from state change to notification.
+Neither Home Assistant, Appdaemon nor Zoneminder are needed, pyzm and requests are.
+
+Usage:
+    python benchmarks/zmbench.py --events 200 --cameras 3 --rate 20 --zm-latency 0.05
+
+A recorded stream is a text file with one state change per line, tab separated:
+    <secs since start>  <sensor id>  <state string>
+e.g.
+    0.0     garage_alert_desc       Garage:(1001) [a] detected:car:78% Linked
+Each sensor id in the recording is registered as a camera, its stub monitor is named after the
+camera of its first state (Garage above). Event ids in a recorded stream are added to the stub
+server's event list of the sensor's monitor as they are replayed.
+'''
+import argparse
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import paho.mqtt.client as paho_mqtt
+except ImportError:
+    paho_mqtt = None
+
+
+class FakeHass:
+    """
+    Stand in for appdaemon.plugins.hass.hassapi.Hass.
+    Like Appdaemon all timer, state and event callbacks of the app run one at a time on a single
+    callback thread, a callback that blocks holds up every other one. Service calls are recorded
+    and can be given a latency.
+    """
+    service_latency = 0.0
+
+    def __init__(self, args=None, states=None):
+        self.args = args if args is not None else {}
+        self.logger = logging.getLogger('zmbench.app')
+        self.states = dict(states) if states is not None else {}
+        self.attributes = {}
+        self.service_calls = []
+        self._state_listeners = {}
+        self._event_listeners = {}
+        self._timers = {}
+        self._timer_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._callbacks = queue.Queue()
+        threading.Thread(target=self._run_callbacks, name='appdaemon', daemon=True).start()
+
+    def _run_callbacks(self):
+        while True:
+            callback, args = self._callbacks.get()
+            try:
+                callback(*args)
+            except Exception:
+                self.logger.exception('callback {} failed'.format(callback.__name__))
+
+    def log(self, msg, *args, **kwargs):
+        self.logger.info(msg)
+
+    def error(self, msg, *args, **kwargs):
+        self.logger.error(msg)
+
+    def get_state(self, entity_id, attribute=None, **kwargs):
+        return self.states.get(entity_id)
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.states[entity_id] = state
+        if attributes is not None:
+            self.attributes[entity_id] = attributes
+
+    def listen_state(self, callback, entity_id, **kwargs):
+        self._state_listeners.setdefault(entity_id, []).append(callback)
+
+    def listen_event(self, callback, event, **kwargs):
+        self._event_listeners.setdefault(event, []).append(callback)
+
+    def call_service(self, service, **kwargs):
+        if self.service_latency:
+            time.sleep(self.service_latency)
+        with self._lock:
+            self.service_calls.append((time.monotonic(), service, kwargs))
+
+    def run_in(self, callback, delay, **kwargs):
+        handle = next(self._timer_ids)
+
+        def fire():
+            if self._timers.pop(handle, None) is not None:
+                self._callbacks.put((callback, (kwargs,)))
+
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        self._timers[handle] = timer
+        timer.start()
+        return handle
+
+    def cancel_timer(self, handle):
+        timer = self._timers.pop(handle, None)
+        if timer is not None:
+            timer.cancel()
+
+    def change_state(self, entity_id, new):
+        old = self.states.get(entity_id)
+        self.states[entity_id] = new
+        for callback in self._state_listeners.get(entity_id, []):
+            self._callbacks.put((callback, (entity_id, 'state', old, new, {})))
+
+    def fire_event(self, event, **data):
+        for callback in self._event_listeners.get(event, []):
+            self._callbacks.put((callback, (event, data, {})))
+
+
+def install_fake_appdaemon():
+    """
+    Make 'import appdaemon.plugins.hass.hassapi as hass' resolve to the fake host.
+    """
+    hassapi = types.ModuleType('appdaemon.plugins.hass.hassapi')
+    hassapi.Hass = FakeHass
+    names = ['appdaemon', 'appdaemon.plugins', 'appdaemon.plugins.hass']
+    for name in names:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules['appdaemon.plugins.hass.hassapi'] = hassapi
+    sys.modules['appdaemon.plugins.hass'].hassapi = hassapi
+
+
+class StubZoneminder:
+    """
+    Minimal Zoneminder API and image view served from memory with a configurable latency.
+    """
+
+    def __init__(self, names, event_list_size, latency=0.0, image=b'', first_id=1):
+        """
+        :param names: monitor names, monitor n (from 1) is names[n - 1]
+        """
+        self.latency = latency
+        self.image = image
+        cameras = len(names)
+        self.monitors = [{'Monitor': {'Id': str(n), 'Name': name, 'Function': 'Modect',
+                                      'Enabled': '1', 'Type': 'Ffmpeg', 'Width': '3840', 'Height': '2160'},
+                          'Monitor_Status': {'Status': 'Connected'}}
+                         for n, name in enumerate(names, 1)]
+        self.events = []
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._next_id = first_id
+        for n in range(0, event_list_size if cameras else 0):
+            self.add_event(n % cameras + 1)
+        self._server = None
+
+    def add_event(self, monitor_id, event_id=None):
+        with self._lock:
+            if event_id is None:
+                event_id = self._next_id
+            self._next_id = max(self._next_id, event_id + 1)
+            self.events.append({'Event': {'Id': str(event_id), 'MonitorId': str(monitor_id),
+                                          'Name': 'Event-{}'.format(event_id), 'Cause': 'Motion',
+                                          'Notes': 'detected:car', 'StartTime': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                          'Length': '10', 'Frames': '100', 'AlarmFrames': '10',
+                                          'TotScore': '1', 'AvgScore': '1', 'MaxScore': '1',
+                                          'MaxScoreFrameId': '5'}})
+        return event_id
+
+    def count(self, key):
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                self.do_GET()
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urllib.parse.urlparse(self.path)
+                content_type, body = stub.handle(urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query))
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, path, query):
+        if path.endswith('/index.php'):
+            self.count('image')
+            event_id = query.get('eid', [''])[0]
+            with self._lock:
+                known = any(e['Event']['Id'] == event_id for e in reversed(self.events))
+            return ('image/jpeg', self.image) if known else ('text/plain', None)
+        key = path.split('/api/')[-1].split('/index')[0]
+        self.count(re.sub(r'\d+', 'N', key))
+        if path.endswith('/host/login.json'):
+            reply = {'apiversion': '2.0', 'version': '1.34.0', 'access_token': 'bench', 'refresh_token': 'bench',
+                     'access_token_expires': 3600, 'refresh_token_expires': 86400}
+        elif path.endswith('/host/gettimezone.json'):
+            reply = {'tz': 'UTC'}
+        elif path.endswith('/configs.json'):
+            reply = {'configs': []}
+        elif path.endswith('/monitors.json'):
+            reply = {'monitors': self.monitors}
+        elif '/monitors/daemonStatus/' in path:
+            reply = {'status': True, 'statustext': 'running'}
+        elif re.search(r'/monitors/\d+\.json$', path):
+            reply = {'message': 'Saved'}
+        elif '/events/index' in path:
+            reply = self.event_page(path, query)
+        else:
+            return 'text/plain', None
+        return 'application/json', json.dumps(reply).encode()
+
+    def event_page(self, path, query):
+        with self._lock:
+            events = list(self.events)
+        for term in path.split('/events/index')[1][:-len('.json')].split('/')[1:]:
+            field, value = term.split(':', 1)
+            field = field.strip()
+            if field == 'MonitorId =':
+                events = [e for e in events if e['Event']['MonitorId'] == value]
+            elif field == 'Id >':
+                events = [e for e in events if int(e['Event']['Id']) > int(value)]
+            elif field == 'Id':
+                events = [e for e in events if int(e['Event']['Id']) == int(value)]
+        events.reverse()
+        limit = int(query.get('limit', ['100'])[0])
+        page = int(query.get('page', ['1'])[0])
+        chunk = events[(page - 1) * limit:page * limit]
+        return {'events': chunk,
+                'pagination': {'count': len(events), 'current': len(chunk), 'nextPage': page * limit < len(events)}}
+
+
+class StubBroker:
+    """
+    Minimal MQTT 3.1.1 broker standing in for mosquitto, enough for the app's paho-mqtt client:
+    connect, subscribe with + and # wildcards, QoS 0 publish and keep alive pings.
+    The benchmark publishes into it directly in place of zoneminder ES.
+    """
+
+    def __init__(self):
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._server = None
+        self.published = 0
+
+    @staticmethod
+    def matches(topic_filter, topic):
+        filter_parts = topic_filter.split('/')
+        topic_parts = topic.split('/')
+        for n, part in enumerate(filter_parts):
+            if part == '#':
+                return True
+            if n >= len(topic_parts) or (part != '+' and part != topic_parts[n]):
+                return False
+        return len(filter_parts) == len(topic_parts)
+
+    @staticmethod
+    def packet(header, body):
+        length = len(body)
+        encoded = bytearray()
+        while True:
+            digit = length % 128
+            length //= 128
+            encoded.append(digit | 0x80 if length else digit)
+            if not length:
+                break
+        return bytes([header]) + bytes(encoded) + body
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def start(self):
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def read(self, size):
+                data = b''
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        raise ConnectionError
+                    data += chunk
+                return data
+
+            def handle(self):
+                lock = threading.Lock()
+                try:
+                    while True:
+                        header = self.read(1)[0]
+                        length, shift = 0, 0
+                        while True:
+                            digit = self.read(1)[0]
+                            length += (digit & 0x7f) << shift
+                            shift += 7
+                            if not digit & 0x80:
+                                break
+                        body = self.read(length)
+                        kind = header >> 4
+                        if kind == 1:
+                            reply = broker.packet(0x20, b'\x00\x00')
+                        elif kind == 8:
+                            topics = []
+                            pos = 2
+                            while pos < len(body):
+                                size = struct.unpack('!H', body[pos:pos + 2])[0]
+                                topics.append(body[pos + 2:pos + 2 + size].decode())
+                                pos += 2 + size + 1
+                            with broker._lock:
+                                broker._subscriptions.extend((self.request, lock, t) for t in topics)
+                            reply = broker.packet(0x90, body[:2] + bytes(len(topics)))
+                        elif kind == 10:
+                            reply = broker.packet(0xb0, body[:2])
+                        elif kind == 12:
+                            reply = broker.packet(0xd0, b'')
+                        elif kind == 14:
+                            break
+                        else:
+                            continue
+                        with lock:
+                            self.request.sendall(reply)
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    with broker._lock:
+                        broker._subscriptions = [s for s in broker._subscriptions if s[0] is not self.request]
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address
+
+    def stop(self):
+        if self._server is not None:
+            with self._lock:
+                for conn, lock, topic_filter in self._subscriptions:
+                    conn.shutdown(socket.SHUT_RDWR)
+            self._server.shutdown()
+            self._server.server_close()
+
+    def publish(self, topic, payload):
+        topic = topic.encode()
+        message = self.packet(0x30, struct.pack('!H', len(topic)) + topic + payload.encode())
+        with self._lock:
+            targets = [(conn, lock) for conn, lock, topic_filter in self._subscriptions
+                       if self.matches(topic_filter, topic.decode())]
+        for conn, lock in targets:
+            with lock:
+                conn.sendall(message)
+        self.published += 1
+
+
+def make_image(width, height):
+    try:
+        from PIL import Image
+    except ImportError:
+        return b'\xff\xd8\xff\xe0' + bytes(width * height // 20)
+    img = Image.effect_noise((width, height), 64).convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+def place_cameras(cameras, servers):
+    """
+    Spread the cameras over the stub servers, camera n (from 1) goes to server (n - 1) % servers.
+    Like separate zoneminder installs each server numbers its monitors from 1.
+    :param cameras: list of (sensor id, monitor name)
+    :return: list of (server index, monitor id) per camera and the list of monitor names per server
+    """
+    placement = []
+    names = [[] for _ in range(0, servers)]
+    for n, (sensor, name) in enumerate(cameras):
+        server = n % servers
+        names[server].append(name)
+        placement.append((server, len(names[server])))
+    return placement, names
+
+
+def synthetic_stream(stubs, cameras, placement, events, rate):
+    """
+    :param cameras: list of (sensor id, monitor name)
+    :param placement: list of (server index, monitor id) per camera, see place_cameras
+    :return: list of (offset secs, sensor id, state, server index, monitor id) with new zoneminder events
+             spread over the cameras
+    """
+    stream = []
+    labels = ['car', 'person', 'dog']
+    for n in range(0, events):
+        sensor, name = cameras[n % len(cameras)]
+        server, monitor_id = placement[n % len(cameras)]
+        event_id = stubs[server].add_event(monitor_id)
+        state = '{}:({}) [a] detected:{}:{}% Linked'.format(name, event_id, labels[n % len(labels)], 50 + n % 50)
+        stream.append((n / rate, sensor, state, server, monitor_id))
+    return stream
+
+
+def mqtt_payload(state, server, monitor_id):
+    """
+    Translate a sensor state into the JSON zoneminder ES publishes on zoneminder/<monitor id>,
+    delivered by the fake host in place of the Appdaemon MQTT plugin or through an MQTT broker.
+    Servers after the first publish on zoneminder<n>/<monitor id>.
+    :return: (topic, payload) or None
+    """
+    m = re.search(r':\((\d+)\)', state)
+    if m is None:
+        return None
+    detection = [{'label': label.strip(), 'confidence': confidence + '%', 'box': [0, 0, 10, 10]}
+                 for label, confidence in re.findall(r'([A-Za-z][\w\- ]*?):(\d{1,3})%', state)]
+    payload = {'monitor': str(monitor_id), 'eventid': m.group(1), 'name': state, 'eventtype': 'event_start',
+               'detection': detection}
+    prefix = 'zoneminder' if server == 0 else 'zoneminder{}'.format(server + 1)
+    return '{}/{}'.format(prefix, monitor_id), json.dumps(payload)
+
+
+def read_recording(path):
+    """
+    :return: list of (offset secs, sensor id, state) of a recorded stream
+    """
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            offset, sensor, state = line.rstrip('\n').split('\t', 2)
+            lines.append((float(offset), sensor, state))
+    return lines
+
+
+def recorded_cameras(recording):
+    """
+    :return: list of (sensor id, monitor name) of the sensors in a recording, in order of first appearance
+    """
+    cameras = OrderedDict()
+    for offset, sensor, state in recording:
+        if sensor not in cameras:
+            m = re.match(r'(.+?):\(\d+\)', state)
+            cameras[sensor] = m.group(1) if m else sensor
+    return list(cameras.items())
+
+
+def recorded_stream(stubs, recording, cameras, placement):
+    """
+    :return: list of (offset secs, sensor id, state, server index, monitor id), the recorded event ids
+             are added to the stub server of the sensor's monitor
+    """
+    placement_by_sensor = {sensor: place for (sensor, name), place in zip(cameras, placement)}
+    stream = []
+    for offset, sensor, state in recording:
+        server, monitor_id = placement_by_sensor[sensor]
+        m = re.search(r':\((\d+)\)', state)
+        if m:
+            stubs[server].add_event(monitor_id, int(m.group(1)))
+        stream.append((offset, sensor, state, server, monitor_id))
+    return stream
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def run(opts):
+    install_fake_appdaemon()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import zmnotify
+
+    image = make_image(opts.image_width, opts.image_width * 9 // 16)
+    if opts.record:
+        recording = read_recording(opts.record)
+        cameras = recorded_cameras(recording)
+    else:
+        cameras = [('cam{}_alert_desc'.format(n), 'Cam{}'.format(n)) for n in range(1, opts.cameras + 1)]
+    placement, stub_names = place_cameras(cameras, max(1, opts.servers))
+    stubs = []
+    for n in range(0, max(1, opts.servers)):
+        latency = opts.slow_latency if n > 0 and n == opts.servers - 1 and opts.slow_latency is not None \
+            else opts.zm_latency
+        # event ids are kept distinct across the stub servers so alerts can be matched by id
+        stubs.append(StubZoneminder(stub_names[n], opts.event_list_size, latency=latency, image=image,
+                                    first_id=n * 10000000 + 1))
+    urls = [stub.start() for stub in stubs]
+    server_names = ['default'] + ['nvr{}'.format(n + 1) for n in range(1, len(stubs))]
+    FakeHass.service_latency = opts.notify_latency
+    broker = None
+    mqtt_opts = {} if opts.mqtt else None
+    if opts.mqtt_broker:
+        if zmnotify.paho_mqtt is None:
+            raise SystemExit('--mqtt-broker needs paho-mqtt installed')
+        if opts.mqtt_broker == 'stub':
+            broker = StubBroker()
+            host, port = broker.start()
+        else:
+            host, port = opts.mqtt_broker.rsplit(':', 1)
+        mqtt_opts = {'broker': host, 'port': int(port)}
+    cache_dir = tempfile.mkdtemp(prefix='zmbench-')
+    sensors = {}
+    states = {'input_boolean.home_occupied': 'off'}
+    for n, (sensor, name) in enumerate(cameras, 1):
+        gate = 'input_boolean.{}_notify'.format(sensor)
+        states[gate] = 'on'
+        sensors[sensor] = {
+            'ha_gate': gate,
+            'zm_monitor': {'name': name, 'function': 'Modect',
+                           'server': server_names[placement[n - 1][0]]},
+            'zm_control': {'allow': True, 'ratelimit': {'window': 300, 'cnt': 1000000, 'reopen': 300}}}
+    args = {'zm_url': urls[0], 'zmapi_loc': '/api', 'zmapi_use_token': True, 'zm_user': 'bench', 'zm_pw': 'bench',
+            'img_width': opts.img_width, 'img_cache_dir': cache_dir, 'img_frame_type': 'o',
+            'txt_blk_list': ['Linked', 'Motion'], 'sensors': sensors, 'occupied': 'input_boolean.home_occupied',
+            'notify-occupied': ['notify/hangouts_bench'],
+            'notify-unoccupied': ['notify/hangouts_bench', 'notify/mobile_bench'],
+            'coalesce_window': opts.coalesce_window,
+            'audit': {'interval': opts.audit_interval, 'jitter': 0} if opts.audit_interval else {},
+            'mqtt': mqtt_opts,
+            'digest': {'unoccupied': {'window': opts.digest}} if opts.digest else {},
+            'workers': {'count': opts.workers, 'queue_depth': opts.queue_depth or max(16, opts.events)},
+            'priority': {'rules': [{'priority': 10, 'labels': ['person']}], 'collapse_below': 5}
+            if opts.priority else {},
+            'zm_servers': {server_names[n]: {'zm_url': urls[n], 'zmapi_loc': '/api', 'zm_user': 'bench',
+                                             'zm_pw': 'bench', 'mqtt_topic': 'zoneminder{}/#'.format(n + 1)}
+                           for n in range(1, len(stubs))}}
+    app = zmnotify.ZmEventNotifier(args=args, states=states)
+    app.initialize()
+    # zoneminder is connected in the background, wait for the sensors to be bound to their monitors
+    deadline = time.monotonic() + opts.timeout
+    while any(s.monitor() is None for s in app.sensors.values()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    publisher = None
+    if broker is not None:
+        # one client per zoneminder server subscribes
+        while broker.subscribers() < len(stubs) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    elif opts.mqtt_broker:
+        publisher = paho_mqtt.Client(paho_mqtt.CallbackAPIVersion.VERSION2) \
+            if hasattr(paho_mqtt, 'CallbackAPIVersion') else paho_mqtt.Client()
+        publisher.connect(mqtt_opts['broker'], mqtt_opts['port'])
+        publisher.loop_start()
+        time.sleep(1)
+
+    if opts.record:
+        stream = recorded_stream(stubs, recording, cameras, placement)
+    else:
+        stream = synthetic_stream(stubs, cameras, placement, opts.events, opts.rate)
+
+    # time each alert from the state change to the completion of its notifications
+    fired = {}
+    fired_label = {}
+    done = {}
+    done_server = {}
+    processed = []
+    process_alert = app.process_alert
+
+    def timed_process_alert(zm_sensor, record):
+        process_alert(zm_sensor, record)
+        processed.append(record.event_id)
+        done[record.event_id] = time.monotonic()
+        done_server[record.event_id] = zm_sensor.server
+
+    for server in app.zm_servers.values():
+        server.pool._handler = timed_process_alert
+
+    start = time.monotonic()
+    for offset, sensor, state, server, monitor_id in stream:
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        m = re.search(r':\((\d+)\)', state)
+        if m:
+            fired.setdefault(int(m.group(1)), time.monotonic())
+            label = re.search(r'detected:(\w+)', state)
+            fired_label[int(m.group(1))] = label.group(1) if label else ''
+        message = mqtt_payload(state, server, monitor_id) if mqtt_opts is not None else None
+        if message is None:
+            pass
+        elif broker is not None:
+            broker.publish(*message)
+        elif publisher is not None:
+            publisher.publish(*message)
+        else:
+            app.fire_event('MQTT_MESSAGE', topic=message[0], payload=message[1])
+        # zoneminder ES sets the HA sensor as well, the app ignores it for servers fed by MQTT
+        app.change_state('sensor.' + sensor, state)
+    deadline = time.monotonic() + opts.timeout
+    while len(done) < len(fired) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = max(done.values()) - start if done else float('nan')
+    if opts.digest:
+        # let the last digest window close before counting the notifier calls
+        time.sleep(opts.digest + 0.5)
+    app.terminate()
+    for stub in stubs:
+        stub.stop()
+    if publisher is not None:
+        publisher.loop_stop()
+        publisher.disconnect()
+    if broker is not None:
+        broker.stop()
+
+    latencies = [done[eid] - fired[eid] for eid in done if eid in fired]
+    report = {
+        'state_changes': len(stream),
+        'alerts': len(done),
+        'dropped': len(fired) - len(done),
+        'duplicate_alerts': len(processed) - len(done),
+        'service_calls': len(app.service_calls),
+        'alerts_per_sec': round(len(done) / elapsed, 2) if done else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'zm_requests': stubs[0].requests
+    }
+    if opts.priority:
+        report['labels'] = {}
+        for label in sorted(set(fired_label.values())):
+            label_latencies = [done[eid] - fired[eid] for eid in done if eid in fired and fired_label[eid] == label]
+            report['labels'][label] = {'fired': sum(1 for eid in fired_label if fired_label[eid] == label),
+                                       'alerts': len(label_latencies),
+                                       'p50_ms': round(percentile(label_latencies, 50) * 1000, 1)}
+    if len(stubs) > 1:
+        report['servers'] = {}
+        for name, stub in zip(server_names, stubs):
+            server_latencies = [done[eid] - fired[eid] for eid in done if eid in fired and done_server[eid] == name]
+            report['servers'][name] = {'alerts': len(server_latencies),
+                                       'p50_ms': round(percentile(server_latencies, 50) * 1000, 1),
+                                       'p99_ms': round(percentile(server_latencies, 99) * 1000, 1),
+                                       'zm_requests': stub.requests}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1], formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--events', type=int, default=100, help='number of synthetic state changes')
+    parser.add_argument('--cameras', type=int, default=3, help='number of cameras/sensors')
+    parser.add_argument('--rate', type=float, default=20, help='synthetic state changes per second')
+    parser.add_argument('--record', help='replay a recorded state stream instead of a synthetic one')
+    parser.add_argument('--event-list-size', type=int, default=500, help='events already known to the stub server')
+    parser.add_argument('--zm-latency', type=float, default=0.02, help='stub zoneminder response latency (secs)')
+    parser.add_argument('--notify-latency', type=float, default=0.0, help='latency of each call_service (secs)')
+    parser.add_argument('--image-width', type=int, default=1920, help='width of the stub image frames')
+    parser.add_argument('--img-width', type=int, default=600, help='app img_width setting')
+    parser.add_argument('--workers', type=int, default=2, help='alert worker threads')
+    parser.add_argument('--coalesce-window', type=float, default=0, help='app coalesce_window setting')
+    parser.add_argument('--servers', type=int, default=1, help='number of stub zoneminder servers')
+    parser.add_argument('--slow-latency', type=float, help='response latency of the last stub server (secs)')
+    parser.add_argument('--audit-interval', type=float, help='app monitor audit interval (secs)')
+    parser.add_argument('--queue-depth', type=int, help='alert queue depth (default: number of events)')
+    parser.add_argument('--priority', action='store_true',
+                        help='prioritise person alerts, collapse the rest per camera, report latency per label')
+    parser.add_argument('--digest', type=float, help='batch the notifications in digest windows of this many secs')
+    parser.add_argument('--mqtt', action='store_true',
+                        help='feed events as zoneminder ES MQTT payloads via the Appdaemon MQTT plugin')
+    parser.add_argument('--mqtt-broker', nargs='?', const='stub', metavar='HOST:PORT',
+                        help='feed the MQTT payloads through a broker and the app\'s paho-mqtt client,\n'
+                             'a built in stand-in unless the address of e.g. a local mosquitto is given')
+    parser.add_argument('--timeout', type=float, default=60, help='max secs to wait for outstanding alerts')
+    parser.add_argument('--verbose', action='store_true', help='show the app log')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if opts.verbose else logging.WARNING,
+                        format='%(asctime)s %(threadName)s %(message)s')
+    print(json.dumps(run(opts), indent=2))
+
+
+if __name__ == '__main__':
+    main()
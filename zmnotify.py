@@ -8,17 +8,37 @@ and then attaches a image frame for the Zoneminder Event Id.
 
 **NOTE:** This is a work in progress.
 '''
+import bisect
+import functools
 import glob
 import os
+import random
+import re
+import tempfile
+import threading
+import time
+import io
+import json
 import traceback
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import appdaemon.plugins.hass.hassapi as hass
 import pyzm.api as zmAPI
 import pyzm.helpers as zmtypes
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime as dt
 import logging
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import paho.mqtt.client as paho_mqtt
+except ImportError:
+    paho_mqtt = None
 
-__version__ = '0.3.8'
+__version__ = '0.4.20'
 
 
 def versiontuple(v):
@@ -49,247 +69,2211 @@ class ZmLogger:
         self.logger.log(logging.FATAL, message)
 
 
+class StageMetrics:
+    """
+    Latency histograms per sensor and processing stage.
+    Each stage keeps fixed bucket counts (cumulative, as exported in the Prometheus text format)
+    and the most recent samples for rolling percentiles. Recording a sample is a bisect and an
+    append under a lock, cheap enough to leave on in production.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    RECENT = 256
+
+    class _Span:
+        __slots__ = ('_metrics', '_name', '_stage', '_start')
+
+        def __init__(self, metrics, name, stage):
+            self._metrics = metrics
+            self._name = name
+            self._stage = stage
+
+        def __enter__(self):
+            self._start = time.perf_counter()
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            self._metrics.record(self._name, self._stage, time.perf_counter() - self._start)
+            return False
+
+    def __init__(self):
+        # (name, stage) -> [bucket counts, sum, count, recent samples]
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def span(self, name, stage):
+        """
+        :return: context manager recording the time spent in the with block
+        """
+        return self._Span(self, name, stage)
+
+    def record(self, name, stage, secs):
+        with self._lock:
+            entry = self._stages.get((name, stage))
+            if entry is None:
+                entry = [[0] * (len(self.BUCKETS) + 1), 0.0, 0, deque(maxlen=self.RECENT)]
+                self._stages[(name, stage)] = entry
+            entry[0][bisect.bisect_left(self.BUCKETS, secs)] += 1
+            entry[1] += secs
+            entry[2] += 1
+            entry[3].append(secs)
+
+    def names(self):
+        with self._lock:
+            return list(OrderedDict.fromkeys(name for name, stage in self._stages))
+
+    def summary(self, name):
+        """
+        :return: dict of stage -> rolling p50/p99/max in ms and total count for one sensor
+        """
+        rv = {}
+        with self._lock:
+            items = [(stage, list(entry[3]), entry[2]) for (n, stage), entry in self._stages.items() if n == name]
+        for stage, recent, count in items:
+            recent.sort()
+            rv[stage] = {
+                'p50_ms': round(recent[len(recent) // 2] * 1000, 1),
+                'p99_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.99))] * 1000, 1),
+                'max_ms': round(recent[-1] * 1000, 1),
+                'count': count
+            }
+        return rv
+
+    def prometheus_text(self):
+        lines = ['# HELP zmnotify_stage_seconds Time spent per zmnotify processing stage',
+                 '# TYPE zmnotify_stage_seconds histogram']
+        with self._lock:
+            items = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self._stages.items()]
+        for (name, stage), buckets, total, count in items:
+            labels = 'sensor="{}",stage="{}"'.format(name, stage)
+            cumulative = 0
+            for le, n in zip(self.BUCKETS + ('+Inf',), buckets):
+                cumulative += n
+                lines.append('zmnotify_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+            lines.append('zmnotify_stage_seconds_sum{{{}}} {}'.format(labels, total))
+            lines.append('zmnotify_stage_seconds_count{{{}}} {}'.format(labels, count))
+        return '\n'.join(lines) + '\n'
+
+
+class ZmEventRecord:
+    """
+    Compact record of one zoneminder event notification as parsed from the sensor state
+    or from the zoneminder ES MQTT payload. monitor_id, boxes and event_type are only known for MQTT.
+    """
+    __slots__ = ('camera', 'event_id', 'frame_code', 'labels', 'confidences', 'text', 'received', 'monitor_id',
+                 'boxes', 'event_type')
+
+    def __init__(self, camera, event_id, frame_code, labels, confidences, text, received=None, monitor_id=None,
+                 boxes=(), event_type=None):
+        self.camera = camera
+        self.event_id = event_id
+        self.frame_code = frame_code
+        self.labels = labels
+        self.confidences = confidences
+        self.text = text
+        self.received = received if received is not None else time.time()
+        self.monitor_id = monitor_id
+        self.boxes = boxes
+        self.event_type = event_type
+
+    def __repr__(self):
+        return "ZmEventRecord({}:({}) [{}] {})".format(self.camera, self.event_id, self.frame_code, self.text)
+
+
+class EventStateParser:
+    """
+    Parses the sensor state string published by zoneminder ES, e.g.
+      "driveway hires:(503) [a] detected:car:78% Linked"
+       camera-name:(event-id) [frame-type] "object detect message"
+    into a ZmEventRecord with one precompiled pattern. Malformed states, including an unknown
+    frame type, are counted and return None rather than raising in the Appdaemon callback.
+    """
+    # only the frame types get_fid knows: alarm, snapshot and objdetect
+    STATE_RE = re.compile(r'^(?P<camera>.+?):\((?P<event_id>\d+)\) \[(?P<frame>[aso])\] ?(?P<text>.*)$', re.DOTALL)
+    OBJECT_RE = re.compile(r'([A-Za-z][\w\- ]*?):(\d{1,3})%')
+
+    def __init__(self):
+        self.parsed = 0
+        self.rejected = 0
+
+    def parse(self, state):
+        m = self.STATE_RE.match(state) if isinstance(state, str) else None
+        if m is None:
+            self.rejected += 1
+            return None
+        text = m.group('text')
+        labels = []
+        confidences = []
+        for label, confidence in self.OBJECT_RE.findall(text):
+            labels.append(label.strip())
+            confidences.append(int(confidence))
+        self.parsed += 1
+        return ZmEventRecord(m.group('camera'), int(m.group('event_id')), m.group('frame'),
+                             tuple(labels), tuple(confidences), text)
+
+    def parse_mqtt(self, payload):
+        """
+        Build a record from the JSON zoneminder ES publishes on zoneminder/<monitor id>, e.g.
+          {"monitor": "1", "eventid": "503", "name": "driveway hires:(503) [a] detected:car:78%",
+           "eventtype": "event_start", "detection": [{"label": "car", "confidence": "78%", "box": [...]}]}
+        :return: ZmEventRecord or None if the payload is malformed
+        """
+        try:
+            msg = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+            event_id = int(msg['eventid'])
+            monitor_id = int(msg['monitor'])
+        except (ValueError, TypeError, KeyError):
+            self.rejected += 1
+            return None
+        record = self.parse(msg.get('name') or '')
+        if record is None:
+            # name without the usual event id/frame markers, fall back to the bare fields
+            self.rejected -= 1
+            self.parsed += 1
+            record = ZmEventRecord(str(msg.get('name') or monitor_id), event_id, 'a', (), (), '')
+        record.event_id = event_id
+        record.monitor_id = monitor_id
+        record.event_type = msg.get('eventtype', 'event_start')
+        detection = msg.get('detection')
+        if isinstance(detection, list) and detection:
+            labels = []
+            confidences = []
+            boxes = []
+            for obj in detection:
+                if not isinstance(obj, dict) or 'label' not in obj:
+                    continue
+                labels.append(str(obj['label']))
+                try:
+                    confidences.append(int(float(str(obj.get('confidence', 0)).rstrip('%'))))
+                except ValueError:
+                    confidences.append(0)
+                boxes.append(tuple(obj.get('box') or ()))
+            record.labels = tuple(labels)
+            record.confidences = tuple(confidences)
+            record.boxes = tuple(boxes)
+        return record
+
+
+class EventCoalescer:
+    """
+    Holds alerts for a short window keyed by event id so that the several messages zoneminder ES
+    publishes for one event (e.g. [a] followed by [o]) produce a single notification.
+    The first message for an event starts the window, later messages replace the held record when
+    their frame type is at least as good (objdetect over alarm over snapshot). When the window
+    closes the held record is passed to the flush callback.
+    """
+    WINDOW = 2
+    FRAME_RANK = {'o': 3, 'a': 2, 's': 1}
+
+    def __init__(self, ad_parent, flush, logger, window=WINDOW):
+        self._ad = ad_parent
+        self._flush = flush
+        self.logger = logger
+        self.window = window
+        # (server, event id) -> [sensor, record]
+        self._pending = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def submit(self, zm_sensor, record):
+        if self.window <= 0:
+            self._flush(zm_sensor, record)
+            return
+        # event ids are only unique per zoneminder server
+        key = (zm_sensor.server, record.event_id)
+        with self._lock:
+            held = self._pending.get(key)
+            if held is None:
+                self._pending[key] = [zm_sensor, record]
+                self._timers[key] = self._ad.run_in(self.close_window, self.window, key=key)
+                return
+            self.coalesced += 1
+            if self.FRAME_RANK.get(record.frame_code, 0) >= self.FRAME_RANK.get(held[1].frame_code, 0):
+                record.received = held[1].received
+                held[1] = record
+
+    def close_window(self, kwargs):
+        key = kwargs['key']
+        with self._lock:
+            self._timers.pop(key, None)
+            held = self._pending.pop(key, None)
+        if held is not None:
+            self._flush(*held)
+
+    def cancel(self):
+        with self._lock:
+            for timer in self._timers.values():
+                self._ad.cancel_timer(timer)
+            self._timers = {}
+            self._pending = {}
+
+
+class TextBlocklist:
+    """
+    Removes every blocklisted token from a message in a single pass using one compiled pattern.
+    """
+
+    def __init__(self, items):
+        # longest first so an entry is not cut short by another entry that is its prefix
+        items = sorted((str(i) for i in items if i), key=len, reverse=True)
+        self._pattern = re.compile('|'.join(re.escape(i) for i in items)) if items else None
+
+    def clean(self, txt_msg):
+        if self._pattern is None:
+            return txt_msg
+        return self._pattern.sub('', txt_msg)
+
+
+class CircuitBreaker:
+    """
+    Shared circuit breaker for the zoneminder API.
+    After threshold consecutive failures the circuit opens and every request is shed without
+    touching the network. Once the backoff has passed one probe request is let through (half open),
+    success closes the circuit, failure opens it again with the backoff doubled up to max_backoff.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    THRESHOLD = 3
+    BACKOFF = 5
+    MAX_BACKOFF = 5 * 60
+
+    def __init__(self, logger, threshold=THRESHOLD, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.logger = logger
+        self.threshold = max(1, int(threshold))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self._failures = 0
+        self._open_cnt = 0
+        self._open_until = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.shed = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def is_open(self):
+        """
+        :return: True while requests are being shed, i.e. open and the backoff has not passed yet,
+                 or half open with the probe request still in flight
+        """
+        if self.state == self.HALF_OPEN:
+            return self._probing
+        return self.state == self.OPEN and time.monotonic() < self._open_until
+
+    def allow(self):
+        """
+        :return: True if a request may be made now, False if it should be shed
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self._open_until:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.shed += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                self.log("Zoneminder API recovered, closing circuit")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._open_cnt = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                self._open_cnt += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (self._open_cnt - 1))
+                self._open_until = time.monotonic() + delay
+                self._probing = False
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self.log("Zoneminder API failing ({} consecutive), circuit open for {}s".format(self._failures,
+                                                                                                 delay))
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'opened': self.opened,
+            'shed': self.shed
+        }
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter applying a default timeout to requests made without one, pyzm sets none.
+    """
+
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
+
+class PooledZMApi(zmAPI.ZMApi):
+    """
+    pyzm ZMApi with the ZmSession adapter mounted on its requests session ahead of the login
+    request, which pyzm makes from its constructor.
+    """
+
+    def __init__(self, options, adapter):
+        self._adapter = adapter
+        super().__init__(options=options)
+
+    def _login(self):
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        super()._login()
+
+
+class ZmSession:
+    """
+    Owns the pyzm ZMApi connection to a Zoneminder server.
+    All API requests and image downloads share one pooled keep-alive requests session, and the
+    access token is refreshed by a background timer before it expires so the alert path does not
+    pay for a TLS handshake or a re-login. Connection reuse, token refresh and retry counts are
+    kept as counters, see stats().
+    Every request goes through a CircuitBreaker so a zoneminder outage costs no worker time,
+    and every request has a timeout.
+    Login, token refresh and the other housekeeping requests of the server run on the session's
+    own admin thread, see submit(), never on the Appdaemon callback thread.
+    """
+    POOL_SIZE = 4
+    CHUNK_SIZE = 64 * 1024
+    REFRESH_MARGIN = 5 * 60
+    REFRESH_CHECK = 60
+    TIMEOUT = 30
+
+    def __init__(self, ad_parent, zm_options, logger, pool_size=POOL_SIZE, refresh_margin=REFRESH_MARGIN,
+                 refresh_check=REFRESH_CHECK, breaker=None, timeout=TIMEOUT, name='zm-admin'):
+        self._ad = ad_parent
+        self.zm_options = zm_options
+        self.logger = logger
+        self.pool_size = pool_size
+        self.refresh_margin = refresh_margin
+        self.refresh_check = refresh_check
+        self.timeout = timeout
+        self.api = None
+        self._admin = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._adapter = None
+        self._token = None
+        self._token_issued = None
+        self._refresh_timer = None
+        self._refresh_lock = threading.Lock()
+        self._local = threading.local()
+        self.breaker = breaker if breaker is not None else CircuitBreaker(logger)
+        self.requests = 0
+        self.retries = 0
+        self.token_refreshes = 0
+        self.relogins = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def submit(self, fn, *args):
+        """
+        Run fn on the admin thread of the session, so a slow or hung zoneminder server does not hold
+        up the Appdaemon callbacks. Exceptions are logged.
+        :return: Future or None if the session is closed
+        """
+        try:
+            future = self._admin.submit(fn, *args)
+        except RuntimeError:
+            return None
+        future.add_done_callback(self._admin_done)
+        return future
+
+    def _admin_done(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        self.log("Zoneminder admin task error: {}".format(str(e)))
+        self.log(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+    def connect(self, retries=2):
+        """
+        Login to zoneminder with the pooled adapter installed on the pyzm session.
+        Blocks for the login requests, call from the admin thread.
+        :return: True if connected
+        """
+        self._adapter = TimeoutHTTPAdapter(self.timeout, pool_connections=self.pool_size,
+                                           pool_maxsize=self.pool_size)
+        api = None
+        for retry in range(0, retries):
+            try:
+                api = PooledZMApi(self.zm_options, self._adapter)
+            except requests.exceptions.RequestException as e:
+                self.log("Encountered {}, retrying, retry cnt: {}".format(type(e).__name__, retry))
+            if api is not None:
+                break
+        if api is None:
+            return False
+        self.api = api
+        self.api.session.hooks['response'].append(self._count_response)
+        self._track_token()
+        self._refresh_timer = self._ad.run_in(self.refresh_token, self.refresh_check)
+        return True
+
+    def close(self):
+        if self._refresh_timer is not None:
+            self._ad.cancel_timer(self._refresh_timer)
+            self._refresh_timer = None
+        self._admin.shutdown(wait=False)
+        if self.api is not None:
+            self.api.session.close()
+
+    def _count_response(self, r, *args, **kwargs):
+        self.requests += 1
+
+    def _track_token(self):
+        """
+        Note the issue time of a new access token, including ones pyzm obtained by itself after a 401.
+        :return: True if the token changed since the last check
+        """
+        token = getattr(self.api, 'access_token', None)
+        if token == self._token:
+            return False
+        if self._token is not None:
+            self.relogins += 1
+        self._token = token
+        self._token_issued = time.monotonic()
+        return True
+
+    def token_remaining(self):
+        """
+        :return: seconds of lifetime left on the access token, None if the API is not using tokens
+        """
+        expires = getattr(self.api, 'access_token_expires', None)
+        if not expires or self._token_issued is None:
+            return None
+        return expires - (time.monotonic() - self._token_issued)
+
+    def refresh_token(self, kwargs):
+        """
+        Timer callback, renews the access token on the admin thread once it is within refresh_margin
+        of expiring.
+        """
+        self._refresh_timer = self._ad.run_in(self.refresh_token, self.refresh_check)
+        self.submit(self.renew_token)
+
+    def renew_token(self):
+        with self._refresh_lock:
+            self._track_token()
+            remaining = self.token_remaining()
+            if remaining is None or remaining > self.refresh_margin or not self.breaker.allow():
+                return
+            self.log("Zoneminder access token expires in {:.0f}s, refreshing".format(remaining))
+            try:
+                self.api._relogin()
+            except requests.exceptions.RequestException as e:
+                self.log("Zoneminder token refresh failed: {}".format(str(e)))
+                self.breaker.failure()
+                return
+            except Exception:
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+            self._token = self.api.access_token
+            self._token_issued = time.monotonic()
+            self.token_refreshes += 1
+
+    def _allow(self):
+        if self.breaker.allow():
+            return True
+        self._local.shed = True
+        return False
+
+    def reset_shed(self):
+        """
+        Start tracking whether requests made by the calling thread are shed, see was_shed().
+        """
+        self._local.shed = False
+
+    def was_shed(self):
+        """
+        :return: True if a request of the calling thread since reset_shed() was shed by the circuit
+                 breaker, so it returned None because zoneminder is unavailable and not on its reply
+        """
+        return getattr(self._local, 'shed', False)
+
+    def call(self, fn, *args, retries=1, what='request'):
+        """
+        Run a pyzm API call, retrying on request errors and the TypeError pyzm raises on a bad response.
+        :return: result of fn or None if every attempt failed or the circuit is open
+        """
+        for retry in range(0, retries + 1):
+            if not self._allow():
+                return None
+            if retry > 0:
+                self.retries += 1
+            try:
+                result = fn(*args)
+            except requests.HTTPError:
+                self.log("Received HTTPError from Zoneminder server on {}, retry: {}".format(what, retry))
+            except requests.exceptions.RequestException as e:
+                self.log("Received {} from Zoneminder server on {}, retry: {}".format(type(e).__name__, what, retry))
+            except TypeError:
+                self.log("Received Type Error from Zoneminder API on {}, retry: {}".format(what, retry))
+            except Exception:
+                # anything else from pyzm, still settle the breaker so a probe is not left in flight
+                self.breaker.failure()
+                raise
+            else:
+                self.breaker.success()
+                return result
+            self.breaker.failure()
+        return None
+
+    def image_url(self, event_id, fid):
+        return self.api.portal_url + '/index.php?view=image&eid={}&fid={}&{}'.format(event_id, fid,
+                                                                                      self.api.get_auth())
+
+    def fetch_image(self, zm_event, fid, max_bytes=None):
+        """
+        Download an event frame over the shared session, replaces pyzm Event.download_image
+        which opens a new connection for every image and always writes a file.
+        :return: image bytes or None on failure
+        """
+        return self.fetch_frame(zm_event.id(), fid, max_bytes=max_bytes)
+
+    def _read_image(self, r, event_id, max_bytes):
+        """
+        Read the streamed response body in CHUNK_SIZE pieces, giving up beyond max_bytes.
+        :return: image bytes or None
+        """
+        chunks = []
+        size = 0
+        for chunk in r.iter_content(self.CHUNK_SIZE):
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                self.log("Image for event {} exceeds {} bytes, dropped".format(event_id, max_bytes))
+                return None
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def fetch_frame(self, event_id, fid, max_bytes=None):
+        """
+        Download a frame straight from the zoneminder image view given only the event id and
+        frame type (or frame number), no Event object is needed. The body is streamed into memory.
+        :param max_bytes: larger images are dropped, e.g. as they would not fit the frame cache
+        :return: image bytes or None on failure or if the circuit is open
+        """
+        for retry in range(0, 2):
+            if not self._allow():
+                return None
+            try:
+                with self.api.session.get(self.image_url(event_id, fid), timeout=self.timeout, stream=True) as r:
+                    r.raise_for_status()
+                    content_type = r.headers.get('Content-Type', '')
+                    data = None
+                    if not content_type.startswith('text/'):
+                        data = self._read_image(r, event_id, max_bytes)
+            except requests.HTTPError as e:
+                self.log("Image download for event {} failed: {}".format(event_id, str(e)))
+                # an unknown event or frame is not an outage
+                if e.response is not None and e.response.status_code < 500:
+                    self.breaker.success()
+                else:
+                    self.breaker.failure()
+                return None
+            except requests.exceptions.RequestException as e:
+                self.log("Image download for event {} failed: {}".format(event_id, str(e)))
+                self.breaker.failure()
+                return None
+            except Exception:
+                self.breaker.failure()
+                raise
+            if "text/html" not in content_type:
+                self.breaker.success()
+                return data
+            # redirected to the login page, the token went stale underneath us
+            self.log("Image download for event {} redirected to login, retry: {}".format(event_id, retry))
+            self.retries += 1
+            with self._refresh_lock:
+                try:
+                    self.api._relogin()
+                except requests.exceptions.RequestException as e:
+                    self.log("Zoneminder relogin failed: {}".format(str(e)))
+                    self.breaker.failure()
+                    return None
+                except Exception:
+                    self.breaker.failure()
+                    raise
+                self._track_token()
+        return None
+
+    def stats(self):
+        connections = 0
+        if self._adapter is not None:
+            pools = self._adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                connections += pool.num_connections
+        return {
+            'requests': self.requests,
+            'connections': connections,
+            'reused': max(0, self.requests - connections),
+            'token_refreshes': self.token_refreshes,
+            'relogins': self.relogins,
+            'retries': self.retries,
+            'circuit': self.breaker.stats()
+        }
+
+
+class LocalFileCache:
+    """
+    Manages the image files written to img_cache_dir.
+    Files are tracked in an in memory index as they are written, the directory is only scanned
+    once at startup. A background timer evicts a bounded number of the oldest files per sweep
+    until every file is younger than max_age and the total size is within max_bytes. Files
+    younger than min_age are never removed so a notifier still uploading one is not cut short.
+    """
+    MAX_AGE = 60 * 60
+    MAX_BYTES = 256 * 1024 * 1024
+    MIN_AGE = 30
+    SWEEP_INTERVAL = 60
+    SWEEP_MAX = 100
+    FILE_PATTERNS = ('*.jpg', '*.jpeg')
+
+    def __init__(self, ad_parent, cache_dir, logger, max_age=MAX_AGE, max_bytes=MAX_BYTES, min_age=MIN_AGE,
+                 sweep_interval=SWEEP_INTERVAL, sweep_max=SWEEP_MAX):
+        self._ad = ad_parent
+        self.cache_dir = cache_dir
+        self.logger = logger
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.sweep_interval = sweep_interval
+        self.sweep_max = sweep_max
+        # file path -> (mtime, size), oldest first
+        self._files = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._sweep_timer = None
+        self.removed = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def __len__(self):
+        return len(self._files)
+
+    def start(self):
+        """
+        Create the cache directory if needed, index the files already in it and start the sweep timer.
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            self.log("Failed to create cache dir {}: {}".format(self.cache_dir, str(e)))
+        found = []
+        for pattern in self.FILE_PATTERNS:
+            for file_path in glob.glob(os.path.join(self.cache_dir, pattern)):
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, file_path, st.st_size))
+        with self._lock:
+            for mtime, file_path, size in sorted(found):
+                self._track(file_path, mtime, size)
+        self.log("Cache dir: {} holds {} files, {} bytes".format(self.cache_dir, len(self._files), self._bytes))
+        self._sweep_timer = self._ad.run_in(self.sweep, self.sweep_interval)
+
+    def stop(self):
+        if self._sweep_timer is not None:
+            self._ad.cancel_timer(self._sweep_timer)
+            self._sweep_timer = None
+
+    def _track(self, file_path, mtime, size):
+        if file_path in self._files:
+            self._bytes -= self._files.pop(file_path)[1]
+        self._files[file_path] = (mtime, size)
+        self._bytes += size
+
+    def add(self, file_path, size):
+        with self._lock:
+            self._track(file_path, time.time(), size)
+
+    def sweep(self, kwargs):
+        """
+        Timer callback, removes at most sweep_max expired or over budget files.
+        """
+        self._sweep_timer = self._ad.run_in(self.sweep, self.sweep_interval)
+        now = time.time()
+        delete_list = []
+        with self._lock:
+            while self._files and len(delete_list) < self.sweep_max:
+                file_path, (mtime, size) = next(iter(self._files.items()))
+                age = now - mtime
+                if age < self.min_age or (age < self.max_age and self._bytes <= self.max_bytes):
+                    break
+                del self._files[file_path]
+                self._bytes -= size
+                delete_list.append(file_path)
+        for file_path in delete_list:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        if delete_list:
+            self.removed += len(delete_list)
+            self.log("Cleaned cache dir: {} removed {} files, {} files remain".format(
+                self.cache_dir, len(delete_list), len(self._files)))
+        return len(delete_list)
+
+    def stats(self):
+        return {
+            'files': len(self._files),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'removed': self.removed
+        }
+
+
+class StateStore:
+    """
+    Snapshot of the runtime state kept on disk so an Appdaemon reload does not lose squelches,
+    rate limit windows, monitor functions, the newest indexed event ids and the frame files
+    already written. Changes are marked dirty and written at most once per debounce secs,
+    the file is replaced atomically. The snapshot dict is built by the snapshot callback.
+    """
+    VERSION = 1
+    DEBOUNCE = 5
+    FILE_NAME = 'zmnotify_state.json'
+
+    def __init__(self, ad_parent, file_path, snapshot, logger, debounce=DEBOUNCE):
+        self._ad = ad_parent
+        self.file_path = file_path
+        self._snapshot = snapshot
+        self.logger = logger
+        self.debounce = debounce
+        self._timer = None
+        self._lock = threading.Lock()
+        self.writes = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def load(self):
+        """
+        :return: the saved state dict, empty if there is none or it can't be read
+        """
+        try:
+            with open(self.file_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.log("Ignoring unreadable state file {}: {}".format(self.file_path, str(e)))
+            return {}
+        if not isinstance(state, dict) or state.get('version') != self.VERSION:
+            self.log("Ignoring state file {} from another version".format(self.file_path))
+            return {}
+        self.log("Restoring state saved {:.0f}s ago from {}".format(time.time() - state.get('saved', 0),
+                                                                    self.file_path))
+        return state
+
+    def mark_dirty(self):
+        with self._lock:
+            if self._timer is None:
+                self._timer = self._ad.run_in(self.flush, self.debounce)
+
+    def flush(self, kwargs=None):
+        with self._lock:
+            self._timer = None
+        try:
+            state = self._snapshot()
+            state['version'] = self.VERSION
+            state['saved'] = time.time()
+            tmp_path = self.file_path + '.part'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_path, self.file_path)
+        except (OSError, RuntimeError, TypeError, ValueError) as e:
+            self.log("Failed to write state file {}: {}".format(self.file_path, str(e)))
+            return
+        self.writes += 1
+
+    def close(self):
+        """
+        Cancel a pending write and write the current state now.
+        """
+        with self._lock:
+            timer = self._timer
+            self._timer = None
+        if timer is not None:
+            self._ad.cancel_timer(timer)
+        self.flush()
+
+
+class FrameCache:
+    """
+    In memory LRU cache of downloaded image frames keyed by (event id, frame type).
+    Zoneminder ES republishes an event id as detection progresses, repeat alerts are served
+    from memory. The total size of the cached frames is held under max_bytes. A frame is
+    only written to img_cache_dir when a notifier needs a file path, see path(). The keys of
+    the last FILE_REFS frames written are remembered so a miss can be served from the file.
+    """
+    MAX_BYTES = 32 * 1024 * 1024
+    FILE_REFS = 256
+
+    def __init__(self, cache_dir, logger, max_bytes=MAX_BYTES, file_cache=None):
+        self.cache_dir = cache_dir
+        self.file_cache = file_cache
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._bytes = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key):
+        with self._lock:
+            data = self._frames.get(key)
+            if data is not None:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return data
+            on_disk = key in self._files
+        if on_disk:
+            try:
+                with open(os.path.join(self.cache_dir, self.filename(key)), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                with self._lock:
+                    self._files.pop(key, None)
+            else:
+                self.put(key, data)
+                with self._lock:
+                    self.hits += 1
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._frames:
+                self._bytes -= len(self._frames.pop(key))
+            if len(data) > self.max_bytes:
+                return
+            self._frames[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                old_key, old_data = self._frames.popitem(last=False)
+                self._bytes -= len(old_data)
+                self.evictions += 1
+
+    @staticmethod
+    def filename(key):
+        return "{}-{}.jpg".format(*key)
+
+    def path(self, key):
+        """
+        Write the cached frame to the cache directory if not already there.
+        :return: path of the image file or None if the frame is not cached or could not be written
+        """
+        file_path = os.path.join(self.cache_dir, self.filename(key))
+        if os.path.exists(file_path):
+            return file_path
+        data = self.get(key)
+        if data is None:
+            return None
+        tmp_path = None
+        try:
+            # unique temp name, two workers may write the same frame at once
+            fd, tmp_path = tempfile.mkstemp(suffix='.part', prefix=self.filename(key) + '.', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            self.log("Failed to write image file {}: {}".format(file_path, str(e)))
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return None
+        if self.file_cache is not None:
+            self.file_cache.add(file_path, len(data))
+        with self._lock:
+            self._files[key] = None
+            self._files.move_to_end(key)
+            while len(self._files) > self.FILE_REFS:
+                self._files.popitem(last=False)
+        return file_path
+
+    def file_refs(self):
+        with self._lock:
+            return [list(key) for key in self._files]
+
+    def restore_file_refs(self, refs):
+        """
+        Remember the frames written before a reload whose files are still in the cache directory.
+        """
+        with self._lock:
+            for ref in refs[-self.FILE_REFS:]:
+                key = tuple(ref)
+                if os.path.exists(os.path.join(self.cache_dir, self.filename(key))):
+                    self._files[key] = None
+
+    def stats(self):
+        return {
+            'frames': len(self._frames),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class ImageResizer:
+    """
+    Scales frames down to img_width and re-encodes them as JPEG at the given quality before
+    they are sent to a notifier. Requires Pillow, without it frames are sent unchanged.
+    Frames already narrower than the target width are passed through as is.
+    """
+    QUALITY = 75
+
+    def __init__(self, width, logger, quality=QUALITY):
+        self.width = int(width)
+        self.quality = int(quality)
+        self.logger = logger
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def key(self, frame_key):
+        """
+        :return: frame cache key of the resized variant, stored alongside the original
+        """
+        return frame_key[0], "{}-w{}".format(frame_key[1], self.width)
+
+    def resize(self, data):
+        """
+        :return: resized JPEG bytes or None if the frame should be used unchanged
+        """
+        try:
+            img = Image.open(io.BytesIO(data))
+            if img.width <= self.width:
+                return None
+            height = max(1, round(img.height * self.width / img.width))
+            img = img.convert('RGB').resize((self.width, height), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, format='JPEG', quality=self.quality, optimize=True)
+        except (OSError, ValueError) as e:
+            self.log("Failed to resize image: {}".format(str(e)))
+            return None
+        resized = out.getvalue()
+        self.bytes_in += len(data)
+        self.bytes_out += len(resized)
+        return resized
+
+
+class ZmEventIndex:
+    """
+    Index of recently seen Zoneminder events for a single monitor.
+    The first refresh pulls the events since start_time, after that only events with an id
+    greater than the newest indexed id are requested from the API. Entries are evicted by
+    age and count so the index stays small regardless of how busy the camera is.
+    If an id is still not found after a refresh, the event is requested directly by id.
+    """
+    MAX_AGE = 60 * 60
+    MAX_EVENTS = 200
+
+    def __init__(self, mo, session, logger, max_age=MAX_AGE, max_events=MAX_EVENTS):
+        self._zm_monitor = mo
+        self._session = session
+        self.logger = logger
+        self.max_age = max_age
+        self.max_events = max_events
+        # event id -> (pyzm Event, monotonic time the event was indexed)
+        self._events = OrderedDict()
+        self._last_id = None
+        self._lock = threading.Lock()
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def __len__(self):
+        return len(self._events)
+
+    def _fetch(self, options):
+        return self._session.call(lambda: self._zm_monitor.events(options).list(), what='events')
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def restore(self, last_id):
+        """
+        Continue from the newest event id indexed before a reload, the first refresh then only
+        requests newer events instead of everything since start_time.
+        """
+        with self._lock:
+            if self._last_id is None and last_id is not None:
+                self._last_id = int(last_id)
+
+    def _add(self, event_list):
+        now = time.monotonic()
+        for event in sorted(event_list, key=lambda x: x.id()):
+            evid = event.id()
+            self._events[evid] = (event, now)
+            self._events.move_to_end(evid)
+            if self._last_id is None or evid > self._last_id:
+                self._last_id = evid
+
+    def _evict(self):
+        expire_time = time.monotonic() - self.max_age
+        while self._events:
+            evid, (event, indexed_at) = next(iter(self._events.items()))
+            if len(self._events) <= self.max_events and indexed_at >= expire_time:
+                break
+            del self._events[evid]
+
+    def refresh(self, start_time='1 hour ago'):
+        """
+        Pull events newer than the last indexed event, or since start_time for an empty index.
+        :return: number of new events added to the index
+        """
+        if self._last_id is None:
+            options = {'from': start_time}
+        else:
+            options = {'raw_filter': '/Id >:{}'.format(self._last_id)}
+        event_list = self._fetch(options)
+        if not event_list:
+            return 0
+        self._add(event_list)
+        self._evict()
+        return len(event_list)
+
+    def lookup(self, event_id, start_time='1 hour ago'):
+        evid = int(event_id)
+        with self._lock:
+            entry = self._events.get(evid)
+            if entry is None and (self._last_id is None or evid > self._last_id):
+                added = self.refresh(start_time)
+                self.log("ZM Monitor ({}) event index added {} events, size {}".format(
+                    self._zm_monitor.name(), added, len(self._events)))
+                entry = self._events.get(evid)
+            if entry is None:
+                # not in the incremental window, e.g. event older than the index or evicted
+                event_list = self._fetch({'raw_filter': '/Id:{}'.format(evid)})
+                if event_list:
+                    self._add(event_list)
+                    self._evict()
+                    entry = self._events.get(evid)
+        return entry[0] if entry is not None else None
+
+
+class ZmMonitor:
+    """
+    Wrapper for Zoneminder Monitor object.
+    This tracks the current state of the monitor e.g. Nodect, Modect, None etc.
+    The user should specify what the enabled state should be e.g. Modect.
+    Instances of this class are used to 'turn off' the camera when the associated notify gate is off.
+    """
+
+    def __init__(self, ad_parent, mo, function, options, logger, session):
+        self._ad = ad_parent
+        self._session = session
+        self._zm_monitor = mo
+        self._settings = {}
+        self.logger = logger
+        self.last_audit_failed = False
+        for key, value in options.items():
+            self._settings[key] = options[key]
+        self._settings['function'] = function
+        # get the current state according to zoneminder
+        self._zm_function = mo.function()
+        self.log("Monitor ({}) is reporting function {}".format(mo.name(), self._zm_function))
+        index_opts = ad_parent.event_index_opts
+        self._event_index = ZmEventIndex(mo, session, logger,
+                                         max_age=index_opts.get('max_age', ZmEventIndex.MAX_AGE),
+                                         max_events=index_opts.get('max_events', ZmEventIndex.MAX_EVENTS))
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    @property
+    def id(self):
+        return self._zm_monitor.id()
+
+    @property
+    def name(self):
+        return self._zm_monitor.name()
+
+    def snapshot(self):
+        return {'zm_function': self._zm_function, 'last_event_id': self._event_index.last_id}
+
+    def restore(self, state):
+        """
+        Apply state saved before a reload. The function reported by zoneminder in the monitor list
+        stays authoritative, a difference to the saved one is only logged.
+        """
+        saved_function = state.get('zm_function')
+        if saved_function is not None and saved_function != self._zm_function:
+            self.log("Monitor ({}) function changed from {} to {} while reloading".format(self.name, saved_function,
+                                                                                         self._zm_function))
+        self._event_index.restore(state.get('last_event_id'))
+
+    def find_event(self, event_id, start_time='1 hour ago'):
+        """
+        Resolve the zoneminder event for the given id from the monitor's event index.
+        :param event_id: zoneminder event id (str or int)
+        :param start_time: how far back to look when the index is first filled
+        :return: pyzm Event or None
+        """
+        return self._event_index.lookup(event_id, start_time)
+
+    def set_zoneminder_state(self, function):
+        options = {'function': function}
+        self.log("Monitor {}: sending zoneminder request to set function state to: {}".format(self.name, function))
+        if self._session.call(lambda: self._zm_monitor.set_parameter(options), retries=0,
+                              what='set function') is None:
+            self.log("Monitor {}: failed to set function state to: {}, audit will retry".format(self.name,
+                                                                                               function))
+
+    def set_function_state(self, function):
+        if function != self._zm_function:
+            self.log(
+                "ZM Monitor ({}) changing func from {} to {}".format(self._zm_monitor.name(), self._zm_function,
+                                                                     function))
+            self.set_zoneminder_state(function)
+            self._zm_function = function
+            self._ad.mark_state_dirty()
+
+    def enable_function(self):
+        self.set_function_state(self._settings['function'])
+
+    def audit_monitor_state(self, mo):
+        """
+        Check that zoneminder reported state matches our state
+        If there is a mismatch, force zoneminder to our set state.
+        Called by the ZmEventNotifier audit cycle with the monitor as loaded by a single
+        bulk monitors request, so the reported function is current rather than the pyzm cached copy.
+        When zoneminder includes the Monitor_Status we also treat a monitor that is not connected
+        as out of sync, otherwise only the reported function is compared.
+        :param mo: freshly loaded pyzm Monitor for this monitor
+        :return:
+        """
+        self._zm_monitor = mo
+        reported_function = mo.function()
+        mo_status = mo.monitor.get('Monitor_Status') or {}
+        is_running = mo_status.get('Status', 'Connected') == 'Connected'
+        # self.log("Audit state of monitor {}, zm reports function: {}".format(self.name, reported_function))
+        if reported_function != self._zm_function or (not is_running and self._zm_function != 'None'):
+            self.last_audit_failed = True
+            self.log("Monitor state mismatch detected by audit (zm reports {}, status {}), "
+                     "set ZM camera {} to {}".format(reported_function, mo_status.get('Status'), self.name,
+                                                     self._zm_function))
+            self.set_zoneminder_state(self._zm_function)
+        elif self.last_audit_failed:
+            self.last_audit_failed = False
+            self.log("Monitor ZM Camera {} audit passed: {}".format(self.name, self._zm_function))
+
+
+class RateLimiter:
+    """
+    Sliding window rate limiter, allows at most cnt events in any window secs.
+    Only the times of the last cnt allowed events are kept, so each check is O(1).
+    When the limit is exceeded the limiter is squelched and rejects every event until
+    reopen secs have passed, after which it starts again with an empty window.
+    """
+
+    def __init__(self, cnt, window, reopen=None):
+        self.cnt = max(1, int(cnt))
+        self.window = float(window)
+        self.reopen = float(reopen) if reopen is not None else self.window
+        self._times = deque(maxlen=self.cnt)
+        self._squelch_until = None
+        self.allowed = 0
+        self.suppressed = 0
+        self.squelches = 0
+
+    def squelched(self, now=None):
+        if self._squelch_until is None:
+            return False
+        if (now if now is not None else time.monotonic()) >= self._squelch_until:
+            self.reset()
+            return False
+        return True
+
+    def allow(self, now=None):
+        """
+        Account for one event.
+        :return: True if the event is within the limit
+        """
+        now = now if now is not None else time.monotonic()
+        if self.squelched(now):
+            self.suppressed += 1
+            return False
+        if len(self._times) == self.cnt and now - self._times[0] < self.window:
+            self._squelch_until = now + self.reopen
+            self.squelches += 1
+            self.suppressed += 1
+            return False
+        self._times.append(now)
+        self.allowed += 1
+        return True
+
+    def reset(self):
+        self._times.clear()
+        self._squelch_until = None
+
+    def snapshot(self):
+        """
+        :return: window and squelch as wall clock times, monotonic times don't survive a restart
+        """
+        offset = time.time() - time.monotonic()
+        return {
+            'times': [t + offset for t in tuple(self._times)],
+            'squelch_until': self._squelch_until + offset if self._squelch_until is not None else None
+        }
+
+    def restore(self, state):
+        offset = time.time() - time.monotonic()
+        self._times.extend(t - offset for t in state.get('times', ())[-self.cnt:])
+        if state.get('squelch_until') is not None:
+            self._squelch_until = state['squelch_until'] - offset
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'suppressed': self.suppressed,
+            'squelches': self.squelches,
+            'squelched': self.squelched()
+        }
+
+
+class HASensor:
+    """
+    Home Assistant Sensor. This is a proxy for the sensor defined in Home Assistant for the
+    Zoneminder monitor. This sensor should be a MQTT sensor.
+    """
+
+    def __init__(self, ad_parent, name, attributes, logger):
+        self._ad = ad_parent
+        self._name = name
+        self.logger = logger
+        self._monitor = None
+        self._session = None
+        self._monitor_name = None
+        self._monitor_function = 'None'
+        self._server = ZmServer.DEFAULT
+        self._cntrl_data = None
+        self._saved_state = {}
+        for key, value in attributes.items():
+            if key == 'zm_monitor':
+                self._monitor_name = value['name']
+                self._monitor_function = value['function']
+                self._server = value.get('server', ZmServer.DEFAULT)
+            elif key == 'zm_control':
+                self.log("Sensor ({}) adding control settings".format(self.name))
+                self._cntrl_data = attributes[key]
+                self.log("Sensor ({}) allow: {}".format(self.name, self._cntrl_data["allow"]))
+            elif key == 'ha_gate':
+                # this is the boolean gate controlled by the user
+                # when true, the monitor function will be set to None if permission is given
+                self._gate = attributes[key]
+        self._allow_monitor_control = True if self._cntrl_data['allow'] else False
+        rt = self._cntrl_data["ratelimit"]
+        # a squelched limiter indicates an active throttle is ongoing for this sensor
+        # squelching stops the forwarding of notifications to HA notify service
+        self._limiter = RateLimiter(rt['cnt'], rt['window'], rt.get('reopen'))
+
+        # the zoneminder monitor is attached by bind_monitor once zoneminder is connected
+        self._current_gate_state = self._ad.get_state(self._gate)
+        self.log("{} is currently {}".format(self._gate, self._current_gate_state))
+        self._ad.listen_state(self.handle_state_change, self._gate)
+
+    def bind_monitor(self, zm_monitor, session):
+        """
+        Attach the zoneminder monitor and push the function matching the current gate state.
+        :param zm_monitor: pyzm Monitor from the monitor list fetched at connect
+        :param session: ZmSession of the zoneminder server the monitor belongs to
+        """
+        self._session = session
+        self._monitor = ZmMonitor(self._ad, zm_monitor, self._monitor_function, self._cntrl_data, self.logger,
+                                  session)
+        if self._saved_state.get('monitor'):
+            self._monitor.restore(self._saved_state['monitor'])
+        self.apply_gate_state()
+
+    def snapshot(self):
+        state = {'limiter': self._limiter.snapshot()}
+        if self._monitor is not None:
+            state['monitor'] = self._monitor.snapshot()
+        elif self._saved_state.get('monitor'):
+            # not bound yet, keep what was restored
+            state['monitor'] = self._saved_state['monitor']
+        return state
+
+    def restore(self, state):
+        """
+        Apply the state saved before a reload, the monitor part is applied once bound.
+        """
+        self._saved_state = state
+        self._limiter.restore(state.get('limiter', {}))
+        if self._limiter.squelched():
+            self.log("Sensor {} squelch restored".format(self.name))
+
+    def apply_gate_state(self):
+        if self._allow_monitor_control and self._current_gate_state == "off":
+            self._monitor.set_function_state('None')
+        elif self._allow_monitor_control and self._current_gate_state == "on":
+            self._monitor.enable_function()
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def ha_gate(self):
+        return self._gate
+
+    @property
+    def monitor_name(self):
+        return self._monitor_name
+
+    @property
+    def server(self):
+        return self._server
+
+    def monitor(self):
+        return self._monitor
+
+    def monitor_id(self):
+        return self._monitor.id if self._monitor is not None else None
+
+    def squelched(self):
+        return self._limiter.squelched()
+
+    def limiter(self):
+        return self._limiter
+
+    def is_notify_enabled(self):
+        return self._current_gate_state == "on"
+
+    def reset_squelch(self):
+        if self._limiter.squelched():
+            self.log("Sensor {} squelch off".format(self.name))
+        self._limiter.reset()
+
+    def handle_state_change(self, entity, attribute, old, new, kwargs):
+        """
+        Callback hook called on input_boolean notify gate.
+        The notify gate is a simple user button that can be turned on or off to easily
+        enable or disable processing zoneminder events.
+
+        :param entity: name of HA entity that has changed state
+        :param attribute:
+        :param old: previous state (off or on)
+        :param new: new/current state of off or on
+        :param kwargs:
+        """
+        self.log("Sensor notify gate state change reported on {} from {} to {}".format(self._gate, old, new))
+        self._current_gate_state = new
+        if self._allow_monitor_control and self._monitor is not None:
+            if new in ("on", "off"):
+                # the monitor function is set by the admin thread of the zoneminder session
+                self._session.submit(self.apply_gate_state)
+                # if user manually turns off notify gate, then should clear squelch
+                # otherwise notify gate will be turned back on with timer expires
+                # self.reset_squelch()
+            else:
+                self.log("ERROR: unexpected state change to {}".format(new))
+
+    def process_event(self):
+        """
+        Account for an alert against the sensor rate limit.
+        :return: True if the alert may be sent
+        """
+        squelches = self._limiter.squelches
+        allowed = self._limiter.allow()
+        if self._limiter.squelches != squelches:
+            self.log("Sensor {} squelched for {}s, more than {} events in {}s".format(
+                self.name, self._limiter.reopen, self._limiter.cnt, self._limiter.window))
+        return allowed
+
+
+class MqttEventSource:
+    """
+    Receives zoneminder ES event payloads directly from MQTT instead of via the HA sensor state.
+    Uses the Appdaemon MQTT plugin namespace, or when a broker host is configured, a paho-mqtt
+    client connected to that broker. Messages are passed to handler(topic, payload).
+    """
+    TOPIC = 'zoneminder/#'
+    NAMESPACE = 'mqtt'
+
+    def __init__(self, ad_parent, handler, logger, topic=TOPIC, namespace=NAMESPACE, broker=None, port=1883,
+                 username=None, password=None):
+        self._ad = ad_parent
+        self._handler = handler
+        self.logger = logger
+        self.topic = topic
+        self.namespace = namespace
+        self.broker = broker
+        self.port = port
+        self.username = username
+        self.password = password
+        self._client = None
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def start(self):
+        if self.broker:
+            if paho_mqtt is None:
+                self.log("paho-mqtt not installed, cannot connect to MQTT broker {}".format(self.broker))
+                return False
+            if hasattr(paho_mqtt, 'CallbackAPIVersion'):
+                # paho-mqtt 2.x needs the callback API version, on_connect gets the version 2 arguments
+                self._client = paho_mqtt.Client(paho_mqtt.CallbackAPIVersion.VERSION2)
+                self._client.on_connect = lambda client, userdata, flags, reason, properties: client.subscribe(
+                    self.topic)
+            else:
+                self._client = paho_mqtt.Client()
+                self._client.on_connect = lambda client, userdata, flags, rc: client.subscribe(self.topic)
+            if self.username:
+                self._client.username_pw_set(self.username, self.password)
+            self._client.on_message = lambda client, userdata, msg: self._handler(msg.topic, msg.payload)
+            self._client.connect_async(self.broker, self.port)
+            self._client.loop_start()
+            self.log("Subscribing to {} on MQTT broker {}:{}".format(self.topic, self.broker, self.port))
+        else:
+            self._ad.call_service("mqtt/subscribe", topic=self.topic, namespace=self.namespace)
+            self._ad.listen_event(self.handle_mqtt_message, "MQTT_MESSAGE", namespace=self.namespace)
+            self.log("Subscribing to {} in Appdaemon namespace {}".format(self.topic, self.namespace))
+        return True
+
+    def stop(self):
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
+
+    @staticmethod
+    def topic_matches(topic_filter, topic):
+        """
+        :return: True if topic matches the subscription topic_filter, with the MQTT + and # wildcards
+        """
+        filter_parts = topic_filter.split('/')
+        topic_parts = topic.split('/')
+        for n, part in enumerate(filter_parts):
+            if part == '#':
+                return True
+            if n >= len(topic_parts) or (part != '+' and part != topic_parts[n]):
+                return False
+        return len(filter_parts) == len(topic_parts)
+
+    def handle_mqtt_message(self, event_name, data, kwargs):
+        # the plugin passes the messages of every subscription, e.g. also those of another server
+        topic = data.get('topic', '')
+        if self.topic_matches(self.topic, topic):
+            self._handler(topic, data.get('payload'))
+
+
+class AlertPriority:
+    """
+    Priority of an alert from rules on the camera, the detected object labels and their confidence,
+    compiled once at initialize, e.g.
+      {priority: 10, labels: [person], min_confidence: 60, cameras: [Front Door]}
+    Each detected object gets the highest priority of the rules it matches or the default priority,
+    the alert gets the highest of its objects. A rule below the default demotes the objects it
+    matches, e.g. with {priority: -5, labels: [car]} a car alert is dropped first, while an alert
+    detecting a car and a person stays at the default.
+    """
+    DEFAULT = 0
+
+    def __init__(self, rules=(), default=DEFAULT):
+        self.default = default
+        self._rules = []
+        for rule in rules:
+            cameras = frozenset(c.lower() for c in rule['cameras']) if rule.get('cameras') else None
+            labels = frozenset(rule['labels']) if rule.get('labels') else None
+            self._rules.append((int(rule['priority']), cameras, labels, rule.get('min_confidence', 0)))
+        # highest priority first so the first match wins
+        self._rules.sort(key=lambda r: -r[0])
+
+    def classify(self, record):
+        """
+        :param record: ZmEventRecord
+        :return: priority of the alert, higher is more urgent
+        """
+        camera = str(record.camera).lower()
+        rules = [r for r in self._rules if r[1] is None or camera in r[1]]
+        if not record.labels:
+            # nothing detected, only rules on the camera alone apply
+            for priority, cameras, labels, min_confidence in rules:
+                if labels is None and not min_confidence:
+                    return priority
+            return self.default
+        best = None
+        for label, confidence in zip(record.labels, record.confidences):
+            label_priority = self.default
+            for priority, cameras, labels, min_confidence in rules:
+                if (labels is None or label in labels) and confidence >= min_confidence:
+                    label_priority = priority
+                    break
+            if best is None or label_priority > best:
+                best = label_priority
+        return best
+
+
+class PriorityJobQueue:
+    """
+    Bounded queue of jobs by priority level, highest level first and FIFO within a level.
+    When full a job of the lowest level present makes room, the oldest of it for drop_oldest,
+    for drop_newest and block (after waiting) the new job is rejected instead if it is of that
+    lowest level. A job of a level below collapse_below replaces a queued job with the same key
+    of its level, so a burst from one camera queues as one low priority alert.
+    """
+
+    def __init__(self, maxsize, collapse_below=None):
+        self.maxsize = max(1, maxsize)
+        self.collapse_below = collapse_below
+        # priority -> deque of [key, job, enqueued monotonic time]
+        self._levels = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self.dropped = {}
+        self.collapsed = {}
+
+    def __len__(self):
+        return self._size
+
+    def depth(self):
+        with self._cond:
+            return {priority: len(level) for priority, level in self._levels.items() if level}
+
+    def _count(self, counter, priority):
+        counter[priority] = counter.get(priority, 0) + 1
+
+    def put(self, job, priority=0, key=None, overflow='drop_oldest', timeout=None, force=False):
+        """
+        :param force: ignore maxsize, used for the worker stop markers
+        :return: True if the job was queued
+        """
+        with self._cond:
+            if key is not None and self.collapse_below is not None and priority < self.collapse_below:
+                for entry in self._levels.get(priority, ()):
+                    if entry[0] == key:
+                        # keep the wait time of the first job
+                        entry[1] = job
+                        self._count(self.collapsed, priority)
+                        return True
+            if not force and self._size >= self.maxsize:
+                if overflow == 'block':
+                    self._cond.wait_for(lambda: self._size < self.maxsize, timeout)
+                if self._size >= self.maxsize:
+                    lowest = min(p for p, level in self._levels.items() if level)
+                    if lowest > priority or (lowest == priority and overflow != 'drop_oldest'):
+                        self._count(self.dropped, priority)
+                        return False
+                    level = self._levels[lowest]
+                    if overflow == 'drop_newest':
+                        level.pop()
+                    else:
+                        level.popleft()
+                    self._size -= 1
+                    self._count(self.dropped, lowest)
+            level = self._levels.get(priority)
+            if level is None:
+                level = self._levels[priority] = deque()
+            level.append([key, job, time.monotonic()])
+            self._size += 1
+            self._cond.notify_all()
+        return True
+
+    def get(self):
+        """
+        Wait for the next job.
+        :return: (job, priority, secs the job waited)
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._size > 0)
+            priority = max(p for p, level in self._levels.items() if level)
+            key, job, enqueued = self._levels[priority].popleft()
+            self._size -= 1
+            self._cond.notify_all()
+        return job, priority, time.monotonic() - enqueued
+
+
+class AlertWorkerPool:
+    """
+    Bounded priority queue of alert jobs serviced by a fixed set of worker threads.
+    The Appdaemon callback only enqueues, the zoneminder fetch and notification fan-out
+    run on the workers so a slow zoneminder response does not hold up other sensors.
+    Jobs are taken highest priority first, see PriorityJobQueue. When the queue is full the
+    lowest priority jobs go first, between jobs of the same priority the overflow policy decides:
+      drop_newest - reject the job being submitted
+      drop_oldest - discard the oldest queued job to make room
+      block - wait up to block_timeout secs for room, then reject
+    The time jobs wait in the queue is recorded per priority in metrics as stage wait_p<priority>.
+    """
+    OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+    _STOP = object()
+
+    def __init__(self, handler, logger, workers=2, queue_depth=16, overflow='drop_oldest', block_timeout=5,
+                 name='zm-alert', collapse_below=None, metrics=None, metrics_name='queue'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("invalid overflow policy {}".format(overflow))
+        self._handler = handler
+        self.logger = logger
+        self.workers = workers
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.name = name
+        self.metrics = metrics
+        self.metrics_name = metrics_name
+        self._queue = PriorityJobQueue(queue_depth, collapse_below=collapse_below)
+        self._threads = []
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def start(self):
+        for n in range(0, self.workers):
+            thread = threading.Thread(target=self._run, name="{}-{}".format(self.name, n), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        for _ in self._threads:
+            # stop markers must get through even if the queue is full
+            self._queue.put(self._STOP, priority=float('inf'), force=True)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def qsize(self):
+        return len(self._queue)
+
+    def submit(self, job, priority=0, key=None):
+        """
+        Queue a job (tuple of handler args) without blocking the caller unless overflow is 'block'.
+        :param priority: higher priority jobs are handled first and dropped last
+        :param key: jobs below the collapse priority with the same key replace each other
+        :return: True if the job was queued
+        """
+        self.submitted += 1
+        return self._queue.put(job, priority=priority, key=key, overflow=self.overflow, timeout=self.block_timeout)
+
+    def _run(self):
+        while True:
+            job, priority, waited = self._queue.get()
+            if job is self._STOP:
+                break
+            if self.metrics is not None:
+                self.metrics.record(self.metrics_name, 'wait_p{}'.format(priority), waited)
+            try:
+                self._handler(*job)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                self.log("Alert worker error: {}".format(str(e)))
+                self.log(traceback.format_exc())
+
+    def stats(self):
+        return {
+            'depth': self._queue.depth(),
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': dict(self._queue.dropped),
+            'collapsed': dict(self._queue.collapsed)
+        }
+
+
+NotifyResult = namedtuple('NotifyResult', ['target', 'status', 'attempts', 'elapsed', 'error'])
+
+
+class NotifyFanout:
+    """
+    Sends one alert to all notify targets concurrently.
+    Each target has its own timeout and retry count (defaults can be overridden per service),
+    a stalled target only costs its own timeout and does not delay delivery to the others.
+    """
+    OK = 'ok'
+    FAILED = 'failed'
+    TIMEOUT = 'timeout'
+    TIMEOUT_SECS = 10
+    RETRIES = 0
+    RETRY_DELAY = 1
+
+    def __init__(self, call_service, logger, max_workers=8, timeout=TIMEOUT_SECS, retries=RETRIES,
+                 retry_delay=RETRY_DELAY, targets=None):
+        self._call_service = call_service
+        self.logger = logger
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # per service overrides e.g. {'tts/google_say': {'timeout': 20, 'retries': 0}}
+        self.targets = targets if targets is not None else {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='zm-notify')
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _target_setting(self, target, key, default):
+        return self.targets.get(target, {}).get(key, default)
+
+    def _send(self, target, kwargs, retries):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._call_service(target, **kwargs)
+                return NotifyResult(target, self.OK, attempt, time.monotonic() - start, None)
+            except Exception as e:
+                if attempt > retries:
+                    return NotifyResult(target, self.FAILED, attempt, time.monotonic() - start, str(e))
+                self.log("Notification to {} failed, retry: {}".format(target, attempt))
+                time.sleep(self.retry_delay)
+
+    def dispatch(self, calls):
+        """
+        Send all service calls concurrently and wait for each up to its own timeout.
+        :param calls: list of (service, kwargs for call_service)
+        :return: list of NotifyResult in the order of calls
+        """
+        start = time.monotonic()
+        pending = []
+        for target, kwargs in calls:
+            retries = self._target_setting(target, 'retries', self.retries)
+            timeout = self._target_setting(target, 'timeout', self.timeout)
+            pending.append((target, timeout, self._executor.submit(self._send, target, kwargs, retries)))
+        results = []
+        for target, timeout, future in pending:
+            remaining = max(0.0, start + timeout - time.monotonic())
+            try:
+                results.append(future.result(timeout=remaining))
+            except FutureTimeoutError:
+                results.append(NotifyResult(target, self.TIMEOUT, None, time.monotonic() - start,
+                                            "no response in {}s".format(timeout)))
+        return results
+
+
+class ZmServer:
+    """
+    One zoneminder server with the resources dedicated to it, the pooled ZmSession (and so its own
+    circuit breaker and admin thread), the alert worker pool, the connect and audit timers and the
+    sensors whose monitors live on it. A slow or unreachable server only ties up its own threads.
+    The legacy top level zm_url config is the server named 'default'.
+    """
+    DEFAULT = 'default'
+
+    def __init__(self, name, session, pool, logger, session_opts=None, mqtt_topic=None):
+        self.name = name
+        self.session = session
+        self.pool = pool
+        self.logger = logger
+        self.session_opts = session_opts if session_opts is not None else {}
+        self.mqtt_topic = mqtt_topic
+        self.mqtt_source = None
+        self.sensors = []
+        self.sensors_by_monitor = {}
+        self.connect_timer = None
+        self.connect_retry = None
+        self.audit_timer = None
+        self.audit_future = None
+
+    def log(self, msg, *args, **kwargs):
+        level = logging.INFO
+        self.logger.log(level, msg, *args, **kwargs)
+
+    @property
+    def api(self):
+        return self.session.api
+
+    @property
+    def audit_metrics_name(self):
+        return 'audit' if self.name == self.DEFAULT else 'audit_{}'.format(self.name)
+
+    def frame_id(self, event_id):
+        """
+        :return: event id qualified by the server for use in frame cache keys and file names
+        """
+        return event_id if self.name == self.DEFAULT else '{}-{}'.format(self.name, event_id)
+
+
+class NotifyDispatcher:
+    """
+    One notification target compiled from the notify-occupied/notify-unoccupied config,
+    optionally restricted to some cameras and/or object labels. Subclasses build the
+    service call payload for their kind of target.
+    """
+    wants_image = False
+
+    def __init__(self, service, entity=None, cameras=None, labels=None):
+        self.service = service
+        self.entity = entity
+        self.cameras = frozenset(c.lower() for c in cameras) if cameras else None
+        self.labels = frozenset(labels) if labels else None
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.service)
+
+    def payload(self, camera, title, body, image_file):
+        raise NotImplementedError
+
+    def text_payload(self, camera, title, body):
+        """
+        Payload without the image, used when zoneminder is unreachable
+        """
+        return dict(message=title + body)
+
+    def digest_payload(self, count, cameras, title, body, image_file):
+        """
+        Payload of a digest combining several alerts, see NotifyDigest
+        """
+        return self.text_payload(', '.join(cameras), title, body)
+
+
+class ImagePushDispatcher(NotifyDispatcher):
+    """
+    Push notification with the frame attached as a file, e.g. notify/hangouts_*
+    """
+    wants_image = True
+
+    def payload(self, camera, title, body, image_file):
+        if image_file is None:
+            # the frame could not be written to the cache dir
+            return self.text_payload(camera, title, body)
+        return dict(message=body, title=title, data={'image_file': image_file})
 
-class ZmMonitor:
-    AUDIT_TIMEOUT = 2 * 60
+    def text_payload(self, camera, title, body):
+        return dict(message=body, title=title)
+
+    def digest_payload(self, count, cameras, title, body, image_file):
+        if image_file is None:
+            return self.text_payload(None, title, body)
+        return self.payload(None, title, body, image_file)
 
+
+class TextPushDispatcher(NotifyDispatcher):
     """
-    Wrapper for Zoneminder Monitor object.
-    This tracks the current state of the monitor e.g. Nodect, Modect, None etc.
-    The user should specify what the enabled state should be e.g. Modect.
-    Instances of this class are used to 'turn off' the camera when the associated notify gate is off.
+    Push notification with only the text
     """
 
-    def __init__(self, ad_parent, mo, function, options, logger):
-        self._zmapi = ad_parent.zm_api
-        self._ad = ad_parent
-        self._zm_monitor = mo
-        self._settings = {}
+    def payload(self, camera, title, body, image_file):
+        return dict(message=title + body)
+
+
+class TtsDispatcher(NotifyDispatcher):
+    """
+    Spoken announcement on a media player, e.g. tts/google_say,media_player.kitchen
+    """
+
+    def payload(self, camera, title, body, image_file):
+        return dict(entity_id=self.entity, message="{} camera {}".format(camera, " ".join(body.split(':'))))
+
+    def text_payload(self, camera, title, body):
+        return self.payload(camera, title, body, None)
+
+    def digest_payload(self, count, cameras, title, body, image_file):
+        return dict(entity_id=self.entity, message="{} camera alerts from {}".format(count, " and ".join(cameras)))
+
+
+class NotifyRoutingTable:
+    """
+    The notify targets for one occupancy state, compiled once at initialize.
+    An entry is either the legacy 'service[,entity]' string or a dict:
+      {service: notify/mobile_app_x, type: image|text|tts, entity: .., cameras: [..], labels: [..]}
+    Nested lists are flattened. The targets matching a camera are resolved once per camera,
+    leaving only the label check per event.
+    """
+    DISPATCHERS = {'image': ImagePushDispatcher, 'text': TextPushDispatcher, 'tts': TtsDispatcher}
+
+    def __init__(self, name, entries, logger):
+        self.name = name
         self.logger = logger
-        self.last_audit_failed = False
-        for key, value in options.items():
-            self._settings[key] = options[key]
-        self._settings['function'] = function
-        # get the current state according to zoneminder
-        self._zm_function = mo.function()
-        self.log("Monitor ({}) is reporting function {}".format(mo.name(), self._zm_function))
-        # audit state every 2 minutes
-        self._audit_timer = self._ad.run_in(self.audit_monitor_state, self.AUDIT_TIMEOUT)
+        self.dispatchers = []
+        self._by_camera = {}
+        # NotifyDigest batching the alerts sent with this table, None to send each alert
+        self.digest = None
+        self._compile(entries)
 
     def log(self, msg, *args, **kwargs):
         level = logging.INFO
         self.logger.log(level, msg, *args, **kwargs)
 
-    @property
-    def id(self):
-        return self._zm_monitor.id()
+    def __len__(self):
+        return len(self.dispatchers)
 
-    @property
-    def name(self):
-        return self._zm_monitor.name()
+    def _compile(self, entries):
+        for entry in entries:
+            if isinstance(entry, (list, tuple)):
+                self._compile(entry)
+                continue
+            if isinstance(entry, dict):
+                spec = dict(entry)
+            else:
+                nlist = str(entry).split(',')
+                spec = {'service': nlist[0].strip(), 'entity': nlist[1].strip() if len(nlist) > 1 else None}
+            dispatcher = self.make_dispatcher(spec)
+            if dispatcher is None:
+                self.log("Dropping {} notifier: {}".format(self.name, entry))
+                continue
+            self.log("adding {} notifier: {}".format(self.name, dispatcher))
+            self.dispatchers.append(dispatcher)
 
-    def find_event(self, event_id, start_time='1 hour ago'):
-        evid = int(event_id)
-        options = {}
-        options['from'] = start_time
-        for retry in range(0, 2):
-            try:
-                event_list = self._zm_monitor.events(options).list()
-                break
-            except requests.HTTPError:
-                self.log("Received HTTPError from Zoneminder server, retry: {}".format(retry))
-            except TypeError:
-                self.log("Received Type Error from Zoneminder API, retry: {}".format(retry))
-        if event_list is None:
+    def make_dispatcher(self, spec):
+        service = spec.get('service', '')
+        kind = spec.get('type')
+        if kind is None:
+            # legacy configs rely on a hint embedded in the name of the notify path
+            if service.startswith('notify/'):
+                kind = 'image' if "hangout" in service else 'text'
+            elif service.startswith('tts/'):
+                kind = 'tts'
+        if kind not in self.DISPATCHERS or (kind == 'tts' and not spec.get('entity')):
             return None
-        self.log("ZM Monitor ({}) reporting {} events".format(self.name, len(event_list)))
-        # return next((x for x in event_list if x.id() == event_id), None)
-        rv = None
-        for x in event_list:
-            if x.id() == evid:
-                rv = x
-                break
-        return rv
-
-    def set_zoneminder_state(self, function):
-        options = {'function': function}
-        self.log("Monitor {}: sending zoneminder request to set function state to: {}".format(self.name, function))
-        self._zm_monitor.set_parameter(options)
-
-    def set_function_state(self, function):
-        if function != self._zm_function:
-            self.log(
-                "ZM Monitor ({}) changing func from {} to {}".format(self._zm_monitor.name(), self._zm_function,
-                                                                     function))
-            self.set_zoneminder_state(function)
-            self._zm_function = function
-
-    def enable_function(self):
-        self.set_function_state(self._settings['function'])
+        return self.DISPATCHERS[kind](service, spec.get('entity'), spec.get('cameras'), spec.get('labels'))
 
-    def audit_monitor_state(self, kwargs):
+    def routes(self, camera, labels):
         """
-        Check that zoneminder reported state matches our state
-        If there is a mismatch, force zoneminder to our set state.
-        We are limited here given the current pyzm monitor proxy caches the state of the monitor-function,
-        the assumption on the part of pyzm is there will never be a need to query to the real current running
-        state of the monitor other than the status() which only reports whether if the monitor is actively running.
-        Consequently, we will assume that 'not running' is equivalent to function mode set to None.
-        :return:
+        :return: list of dispatchers for an event from camera with the detected labels
         """
-        status = None
-        # make sure to start timer for next audit cycle
-        self._audit_timer = self._ad.run_in(self.audit_monitor_state, self.AUDIT_TIMEOUT)
-        for retry in range(0, 1):
-            try:
-                status = self._zm_monitor.status()  # query running status of monitor
-            except requests.exceptions.HTTPError as err:
-                self.log("Audit monitor ({}) status request failed".format(self.name))
-            except TypeError as err:
-                self.log("Audit monitor ({})status request failed likely to expired token?".format(self.name))
-        if status is None:
-            return
-        is_running = status['status']
-        # self.log("Audit state of monitor {}, zm reports state: {}".format(self.name, status['statustext']))
-        if not is_running and self._zm_function != 'None':
-            self.last_audit_failed = True
-            self.log("Monitor state mismatch detected by audit, "
-                     "set ZM camera {} to {}".format(self.name, self._zm_function))
-            self.set_zoneminder_state(self._zm_function)
-        elif self.last_audit_failed:
-            self.last_audit_failed = False
-            self.log("Monitor ZM Camera {} audit passed: {}".format(self.name, self._zm_function))
+        by_camera = self._by_camera.get(camera)
+        if by_camera is None:
+            cam = str(camera).lower()
+            by_camera = [d for d in self.dispatchers if d.cameras is None or cam in d.cameras]
+            self._by_camera[camera] = by_camera
+        return [d for d in by_camera if d.labels is None or not d.labels.isdisjoint(labels)]
 
 
-class HASensor:
+DigestItem = namedtuple('DigestItem', ['routes', 'camera', 'received', 'text', 'frame_key'])
+
+
+class NotifyDigest:
     """
-    Home Assistant Sensor. This is a proxy for the sensor defined in Home Assistant for the
-    Zoneminder monitor. This sensor should be a MQTT sensor.
+    Gathers the alerts of a routing table for window secs, then sends one notification per target
+    with a line per alert. Image targets get the frame of a lone alert, or when several alerts carry
+    frames a contact sheet of up to max_frames thumbnails built from the frame cache (needs Pillow,
+    otherwise the first frame). The number of notifier calls follows the windows, not the events.
+    The timer callback only takes the alerts of the window, the digest is built and sent by flush()
+    on the digest's own thread, not on a notify thread as flush waits for the notifications.
     """
+    WINDOW = 60
+    MAX_FRAMES = 6
+    THUMB_WIDTH = 480
+    QUALITY = 80
 
-    def __init__(self, ad_parent, name, attributes, logger):
+    def __init__(self, ad_parent, send, frame_cache, logger, window=WINDOW, max_frames=MAX_FRAMES,
+                 thumb_width=THUMB_WIDTH, contact_sheet=True, ts_fmt='%a %I:%M %p', name='zm-digest'):
         self._ad = ad_parent
-        self._name = name
+        self._send = send
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.frame_cache = frame_cache
         self.logger = logger
-        zm_monitor = None
-        self._cntrl_data = None
-        self._event_cnt = 0
-        self._window_timer = None
-        # monitor_squelched indicates an active throttle is ongoing for this sensor
-        # squelching true stops the forwarding of notifications to HA notify service
-        self._monitor_squelched = False
-        mfnc = 'None'
-        for key, value in attributes.items():
-            if key == 'zm_monitor':
-                mname = value['name']
-                mfnc = value['function']
-                zm_monitor = self._ad.zm_api.monitors().find(name=mname)
-                if zm_monitor is None:
-                    self.log('Failed to find Zoneminder monitor: {}'.format(mname))
-            elif key == 'zm_control':
-                self.log("Sensor ({}) adding control settings".format(self.name))
-                self._cntrl_data = attributes[key]
-                self.log("Sensor ({}) allow: {}".format(self.name, self._cntrl_data["allow"]))
-            elif key == 'ha_gate':
-                # this is the boolean gate controlled by the user
-                # when true, the monitor function will be set to None if permission is given
-                self._gate = attributes[key]
-        self._allow_monitor_control = True if self._cntrl_data['allow'] else False
-        for key, value in self._cntrl_data["ratelimit"].items():
-            if key == 'cnt':
-                self._cntrl_data["ratelimit"][key] = int(value)
-
-        if zm_monitor is not None:
-            self._monitor = ZmMonitor(ad_parent, zm_monitor, mfnc, self._cntrl_data, logger)
-        else:
-            raise TypeError
-
-        self._current_gate_state = self._ad.get_state(self._gate)
-        self.log("{} is currently {}".format(self._gate, self._current_gate_state))
-        if self._allow_monitor_control and self._current_gate_state == "off":
-            self._monitor.set_function_state('None')
-        elif self._allow_monitor_control and self._current_gate_state == "on":
-            self._monitor.enable_function()
-
-        self._ad.listen_state(self.handle_state_change, self._gate)
+        self.window = window
+        self.max_frames = max(1, int(max_frames))
+        self.thumb_width = int(thumb_width)
+        self.contact_sheet = contact_sheet and Image is not None
+        self.ts_fmt = ts_fmt
+        self._items = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self.digests = 0
+        self.alerts = 0
 
     def log(self, msg, *args, **kwargs):
         level = logging.INFO
         self.logger.log(level, msg, *args, **kwargs)
 
-    @property
-    def name(self):
-        return self._name
-
-    @property
-    def ha_gate(self):
-        return self._gate
-
-    def monitor(self):
-        return self._monitor
-
-    def monitor_id(self):
-        return self._monitor.id()
+    def add(self, routes, record, frame_key):
+        """
+        :param routes: dispatchers the alert is routed to
+        :param record: ZmEventRecord of the alert
+        :param frame_key: frame cache key of the frame to send, None for text only
+        """
+        with self._lock:
+            self._items.append(DigestItem(routes, record.camera, record.received, record.text, frame_key))
+            if self._timer is None:
+                self._timer = self._ad.run_in(self.close_window, self.window)
 
-    def squelched(self):
-        return self._monitor_squelched
+    def close(self):
+        """
+        Cancel the window timer and send the alerts gathered so far instead of dropping them,
+        waits until the digest has been sent.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._ad.cancel_timer(self._timer)
+            self._timer = None
+            items = self._items
+            self._items = []
+        if items:
+            self.submit(items)
+        self._executor.shutdown(wait=True)
 
-    def is_notify_enabled(self):
-        return self._current_gate_state == "on"
+    def close_window(self, kwargs):
+        with self._lock:
+            items = self._items
+            self._items = []
+            self._timer = None
+        if items:
+            self.submit(items)
 
-    def reset_squelch(self):
-        self._event_cnt = 0
-        if self._window_timer is not None:
-            self._ad.cancel_timer(self._window_timer)
-        self._window_timer = None
-        if self._monitor_squelched:
-            self._monitor_squelched = False
-            self.log("Sensor {} squelch off".format(self.name))
-            # self._ad.set_state(self._gate, state="on")
+    def submit(self, items):
+        try:
+            future = self._executor.submit(self.flush, items)
+        except RuntimeError:
+            self.log("Digest closed, {} alerts not sent".format(len(items)))
+            return
+        future.add_done_callback(self._flush_done)
 
-    def set_squelch(self):
-        if self.is_notify_enabled() and self._window_timer is not None:
-            self.log("Sensor {} squelched at event cnt: {}".format(self.name, self._event_cnt))
-            # self._ad.set_state(self._gate, state="off")
-            self._monitor_squelched = True
+    def _flush_done(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        self.log("Digest error: {}".format(str(e)))
+        self.log(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
 
-    def handle_state_change(self, entity, attribute, old, new, kwargs):
+    def flush(self, items):
         """
-        Callback hook called on input_boolean notify gate.
-        The notify gate is a simple user button that can be turned on or off to easily
-        enable or disable processing zoneminder events.
-
-        :param entity: name of HA entity that has changed state
-        :param attribute:
-        :param old: previous state (off or on)
-        :param new: new/current state of off or on
-        :param kwargs:
+        Build the digest of the alerts of a window and send it, blocks until the targets answered.
+        :param items: list of DigestItem
         """
-        self.log("Sensor notify gate state change reported on {} from {} to {}".format(self._gate, old, new))
-        if self._allow_monitor_control:
-            if new == "on":
-                self._monitor.enable_function()
-            elif new == "off":
-                self._monitor.set_function_state('None')
-                # if user manually turns off notify gate, then should clear squelch
-                # otherwise notify gate will be turned back on with timer expires
-                # self.reset_squelch()
-            else:
-                self.log("ERROR: unexpected state change to {}".format(new))
-        self._current_gate_state = new
+        # group the alerts by target, keeping the order of the targets and of the alerts
+        groups = OrderedDict()
+        for item in items:
+            for dispatcher in item.routes:
+                groups.setdefault(dispatcher, []).append(item)
+        sheets = {}
+        calls = []
+        for dispatcher, group in groups.items():
+            if len(group) == 1:
+                item = group[0]
+                title = '{} Camera alert @{}\n'.format(item.camera, dt.fromtimestamp(item.received).strftime(
+                    self.ts_fmt))
+                image_file = self.frame_cache.path(item.frame_key) if item.frame_key is not None else None
+                if image_file is None:
+                    calls.append((dispatcher.service, dispatcher.text_payload(item.camera, title, item.text)))
+                else:
+                    calls.append((dispatcher.service, dispatcher.payload(item.camera, title, item.text,
+                                                                         image_file)))
+                continue
+            cameras = list(OrderedDict.fromkeys(item.camera for item in group))
+            title = '{} camera alerts @{}\n'.format(len(group), dt.fromtimestamp(group[0].received).strftime(
+                self.ts_fmt))
+            body = '\n'.join('{} {}: {}'.format(dt.fromtimestamp(item.received).strftime('%I:%M:%S'), item.camera,
+                                                item.text) for item in group)
+            image_file = None
+            if dispatcher.wants_image:
+                frame_keys = tuple(item.frame_key for item in group if item.frame_key is not None)[:self.max_frames]
+                if frame_keys not in sheets:
+                    sheets[frame_keys] = self.image_file(frame_keys)
+                image_file = sheets[frame_keys]
+            calls.append((dispatcher.service, dispatcher.digest_payload(len(group), cameras, title, body,
+                                                                                image_file)))
+        self.digests += 1
+        self.alerts += len(items)
+        self.log("Sending digest of {} alerts to {} targets".format(len(items), len(calls)))
+        self._send(calls, 'digest')
 
-    def process_event(self):
-        self._event_cnt += 1
-        rt = self._cntrl_data["ratelimit"]
-        if self._window_timer is None:
-            self._window_timer = self._ad.run_in(self.handle_window_timer, rt["window"])
-        if self._event_cnt > rt['cnt']:
-            self.set_squelch()
+    def image_file(self, frame_keys):
+        """
+        :return: path of the image for the given frames, a contact sheet if there are several
+        """
+        if not frame_keys:
+            return None
+        if len(frame_keys) > 1 and self.contact_sheet:
+            sheet = self.build_contact_sheet(frame_keys)
+            if sheet is not None:
+                key = ('digest-{}'.format(int(time.time() * 1000)), 'sheet')
+                self.frame_cache.put(key, sheet)
+                file_path = self.frame_cache.path(key)
+                if file_path is not None:
+                    return file_path
+        return self.frame_cache.path(frame_keys[0])
 
-    def handle_window_timer(self, kwargs):
-        self._window_timer = None
-        self.log("Rate limit window timer expired on sensor {}".format(self.name))
-        self.reset_squelch()
+    def build_contact_sheet(self, frame_keys):
+        """
+        :return: JPEG bytes of a grid of thumbnails of the cached frames or None
+        """
+        thumbs = []
+        try:
+            for key in frame_keys:
+                data = self.frame_cache.get(key)
+                if data is None:
+                    continue
+                img = Image.open(io.BytesIO(data))
+                img.draft('RGB', (self.thumb_width, self.thumb_width))
+                img = img.convert('RGB')
+                img.thumbnail((self.thumb_width, self.thumb_width), Image.LANCZOS)
+                thumbs.append(img)
+            if len(thumbs) < 2:
+                return None
+            cols = 2 if len(thumbs) <= 4 else 3
+            rows = (len(thumbs) + cols - 1) // cols
+            cell_w = max(img.width for img in thumbs)
+            cell_h = max(img.height for img in thumbs)
+            sheet = Image.new('RGB', (cols * cell_w, rows * cell_h))
+            for n, img in enumerate(thumbs):
+                sheet.paste(img, ((n % cols) * cell_w, (n // cols) * cell_h))
+            out = io.BytesIO()
+            sheet.save(out, format='JPEG', quality=self.QUALITY)
+        except (OSError, ValueError) as e:
+            self.log("Failed to build contact sheet: {}".format(str(e)))
+            return None
+        return out.getvalue()
 
 
 # noinspection PyAttributeOutsideInit
@@ -297,33 +2281,48 @@ class ZmEventNotifier(hass.Hass):
     """
     Appdaemon class.
     """
-    zm_api: zmAPI.ZMApi
     img_types = ['jpg', 'gif', 'png', 'tif', 'svg', 'jpeg']
     ts_fmt = '%a %I:%M %p'
     log_header = 'ZM ES Handler'
-    CLEANUP_INTERVAL = 24*60*60
+    AUDIT_INTERVAL = 2 * 60
+    STATS_INTERVAL = 60 * 60
+    METRICS_INTERVAL = 60
+    CONNECT_RETRY_MIN = 5
+    CONNECT_RETRY_MAX = 5 * 60
+    STARTUP_WORKERS = 8
+    AUDIT_JITTER = 10
 
     def init(self):
         self._version = __version__
-        self.notify_occup_list = []
-        self.notify_unoccup_list = []
+        self.notify_tables = {}
         self.occupied_state = False
-        self.notify_list = self.notify_unoccup_list
-        self.zm_options = {
-            'apiurl': None,
-            'portalurl': None,
-            'user': None,
-            'password': None,
-            'logger': None,  # 'logger': None # use none if you don't want to log to ZM
-            'token': True
-        }
+        self.notify_table = None
         self.sensors = {}
-        self.zm_api = None
+        self.zm_servers = {}
+        self.session_opts = {}
         self.img_width = 600
         self.img_cache_dir = '/tmp'
         self.zm_monitors = None
-        self.cache_file_cnt = 0
-        self.last_cleanup = dt.now()
+        self.event_index_opts = {}
+        self.worker_opts = {}
+        self.notify_opts = {}
+        self._notify_fanout = None
+        self.audit_opts = {}
+        self.file_cache = None
+        self._stats_timer = None
+        self.metrics = StageMetrics()
+        self.metrics_opts = {}
+        self._metrics_timer = None
+        self.state_parser = EventStateParser()
+        self.coalescer = None
+        self.global_limiter = None
+        self.alert_priority = AlertPriority()
+        self.priority_opts = {}
+        self.mqtt_opts = None
+        self.state_store = None
+        self.txt_blocklist = None
+        self.frame_cache = None
+        self.img_resizer = None
 
     @staticmethod
     def version():
@@ -336,92 +2335,414 @@ class ZmEventNotifier(hass.Hass):
         self.log('{} initializing version {}'.format(self.log_header, self.version()))
         self.init()
         try:
-            self.zm_options['apiurl'] = self.args["zm_url"] + self.args["zmapi_loc"]
-            self.zm_options['portalurl'] = self.args["zm_url"]
-            self.zm_options['user'] = self.args["zm_user"]
-            self.zm_options['password'] = self.args["zm_pw"]
-            self.zm_options['logger'] = ZmLogger(self.logger)
             self.img_width = self.args["img_width"]
             self.img_cache_dir = self.args["img_cache_dir"]
+            if self.img_width and Image is not None:
+                self.img_resizer = ImageResizer(self.img_width, self.logger,
+                                                quality=self.args.get("img_quality", ImageResizer.QUALITY))
+            elif self.img_width:
+                self.log("Pillow not installed, img_width ignored and images sent at full size")
             self.img_frame_type = self.args["img_frame_type"]
             self.txt_blk_list = self.args["txt_blk_list"]
+            self.txt_blocklist = TextBlocklist(self.txt_blk_list)
+            cache_opts = self.args.get("img_cache", {})
+            self.file_cache = LocalFileCache(self, self.img_cache_dir, self.logger,
+                                             max_age=cache_opts.get('max_age', LocalFileCache.MAX_AGE),
+                                             max_bytes=int(cache_opts.get('max_bytes', LocalFileCache.MAX_BYTES)),
+                                             sweep_interval=cache_opts.get('sweep_interval',
+                                                                           LocalFileCache.SWEEP_INTERVAL))
+            self.frame_cache = FrameCache(self.img_cache_dir, self.logger,
+                                          max_bytes=int(self.args.get("frame_cache_bytes", FrameCache.MAX_BYTES)),
+                                          file_cache=self.file_cache)
+            self.event_index_opts = self.args.get("event_index", {})
+            self.worker_opts = self.args.get("workers", {})
+            self.notify_opts = self.args.get("notify", {})
+            self.audit_opts = self.args.get("audit", {})
+            if "global_ratelimit" in self.args:
+                rt = self.args["global_ratelimit"]
+                self.global_limiter = RateLimiter(rt['cnt'], rt['window'], rt.get('reopen'))
+            self.session_opts = self.args.get("zm_session", {})
+            self.metrics_opts = self.args.get("metrics", {})
+            self.mqtt_opts = self.args.get("mqtt")
+            self.priority_opts = self.args.get("priority", {})
+            self.alert_priority = AlertPriority(self.priority_opts.get('rules', []),
+                                                default=self.priority_opts.get('default', AlertPriority.DEFAULT))
+            state_opts = self.args.get("state", {})
+            if state_opts.get('enabled', True):
+                self.state_store = StateStore(self, state_opts.get('file',
+                                                                   os.path.join(self.img_cache_dir,
+                                                                                StateStore.FILE_NAME)),
+                                              self.runtime_state, self.logger,
+                                              debounce=state_opts.get('debounce', StateStore.DEBOUNCE))
 
-            for notify_id in self.args["notify-occupied"]:
-                if notify_id is list:
-                    self.notify_occup_list.extend(notify_id)
-                else:
-                    self.notify_occup_list.append(notify_id)
-                    self.log("adding occupied notifier: {}".format(notify_id))
-            for notify_id in self.args["notify-unoccupied"]:
-                if notify_id is list:
-                    self.notify_unoccup_list.extend(notify_id)
-                else:
-                    self.notify_unoccup_list.append(notify_id)
-                    self.log("adding unoccupied notifier: {}".format(notify_id))
+            self.notify_tables = {
+                True: NotifyRoutingTable("occupied", self.args["notify-occupied"], self.logger),
+                False: NotifyRoutingTable("unoccupied", self.args["notify-unoccupied"], self.logger)
+            }
 
-            if not self.args["zmapi_use_token"]:
-                self.zm_options['token'] = False
+            # zoneminder servers, the legacy top level settings are the 'default' server
+            server_cfgs = dict(self.args.get("zm_servers", {}))
+            if "zm_url" in self.args:
+                server_cfgs.setdefault(ZmServer.DEFAULT, self.args)
+            for name, server_cfg in server_cfgs.items():
+                self.zm_servers[name] = self.make_server(name, server_cfg)
         except KeyError:
             self.log("Missing arguments in yaml setup file")
             raise
-        self.clean_files_in_local_cache()
-        if self.zm_api is None:
-            for retry in range(0, 2):
-                try:
-                    self.zm_api = zmAPI.ZMApi(options=self.zm_options)
-                except requests.HTTPError:
-                    self.error("Encountered HTTPError, retrying, retry cnt: {}".format(retry))
-                if self.zm_api is not None:
-                    break
-            if self.zm_api is None:
-                self.error("Failed to connect to Zoneminder, aborting")
-                return
-            try:
-                version_info = self.zm_api.version()
-                if version_info is not None and version_info['status'] == 'ok':
-                    self.log("Connected to Zoneminder server reporting"
-                             " version {}".format(version_info['zm_version']))
-                    self.log("API pyzm reporting version {}".format(version_info['api_version']))
-                else:
-                    self.error("Failed to retrieve version info for Zoneminder")
-            except Exception as e:
-                self.error('Error: {}'.format(str(e)))
-                self.error(traceback.format_exc())
-                raise
+        self.file_cache.start()
+        for server in self.zm_servers.values():
+            server.pool.start()
+        self.coalescer = EventCoalescer(self, self.queue_alert, self.logger,
+                                        window=self.args.get("coalesce_window", EventCoalescer.WINDOW))
+        self._notify_fanout = NotifyFanout(self.call_service, self.logger,
+                                           max_workers=int(self.notify_opts.get('max_workers', 8)),
+                                           timeout=self.notify_opts.get('timeout', NotifyFanout.TIMEOUT_SECS),
+                                           retries=int(self.notify_opts.get('retries', NotifyFanout.RETRIES)),
+                                           retry_delay=self.notify_opts.get('retry_delay', NotifyFanout.RETRY_DELAY),
+                                           targets=self.notify_opts.get('targets', {}))
+        for table in self.notify_tables.values():
+            digest_opts = self.args.get("digest", {}).get(table.name)
+            if digest_opts is None:
+                continue
+            table.digest = NotifyDigest(self, self.send_notifications, self.frame_cache, self.logger,
+                                        window=digest_opts.get('window', NotifyDigest.WINDOW),
+                                        max_frames=digest_opts.get('max_frames', NotifyDigest.MAX_FRAMES),
+                                        thumb_width=digest_opts.get('thumb_width', NotifyDigest.THUMB_WIDTH),
+                                        contact_sheet=digest_opts.get('contact_sheet', True),
+                                        ts_fmt=self.ts_fmt, name='zm-digest-{}'.format(table.name))
+            self.log("{} notifications sent as a digest every {}s".format(table.name, table.digest.window))
         occupied_bool = self.args["occupied"]
         self.occupied_state = True if self.get_state(occupied_bool) == 'on' else False
         self.listen_state(self.handle_occupied_state_change, occupied_bool)
-        if self.occupied_state:
-            self.notify_list = self.notify_occup_list
-            self.log("Setting to {} notify list, len={}".format("occupied", len(self.notify_list)))
+        self.notify_table = self.notify_tables[self.occupied_state]
+        self.log("Setting to {} notify list, len={}".format(self.notify_table.name, len(self.notify_table)))
+
+        # a server whose zoneminder ES events come from MQTT ignores the state of its sensors, ES
+        # publishes each event both ways and it would otherwise be notified twice
+        for server in self.zm_servers.values():
+            if self.mqtt_opts is None or not server.mqtt_topic:
+                continue
+            mqtt_source = MqttEventSource(self, functools.partial(self.handle_mqtt_event, server=server),
+                                          self.logger, topic=server.mqtt_topic,
+                                          namespace=self.mqtt_opts.get('namespace', MqttEventSource.NAMESPACE),
+                                          broker=self.mqtt_opts.get('broker'),
+                                          port=int(self.mqtt_opts.get('port', 1883)),
+                                          username=self.mqtt_opts.get('user'),
+                                          password=self.mqtt_opts.get('password'))
+            if mqtt_source.start():
+                server.mqtt_source = mqtt_source
+            else:
+                self.error("MQTT unavailable for zoneminder server {}, using the sensor states".format(server.name))
 
         # sensors is a dict of sensorid with associated notify gate
         for sensor in self.args["sensors"]:
             new_sensor = "sensor." + sensor
-            self.log("adding listener for sensor {}".format(new_sensor))
             self.sensors[new_sensor] = HASensor(self, new_sensor, self.args["sensors"][sensor], self.logger)
-            self.listen_state(self.handle_state_change, new_sensor)
+            server = self.zm_servers.get(self.sensors[new_sensor].server)
+            if server is not None and server.mqtt_source is not None:
+                self.log("sensor {} events taken from MQTT {}".format(new_sensor, server.mqtt_topic))
+            else:
+                self.log("adding listener for sensor {}".format(new_sensor))
+                self.listen_state(self.handle_state_change, new_sensor)
+            if server is None:
+                self.error("Sensor {} refers to unknown zoneminder server {}".format(
+                    new_sensor, self.sensors[new_sensor].server))
+                continue
+            server.sensors.append(self.sensors[new_sensor])
+        if self.state_store is not None:
+            self.restore_runtime_state(self.state_store.load())
+
+        for server in self.zm_servers.values():
+            # connect to zoneminder in the background, sensors are bound to their monitors once connected
+            server.connect_retry = self.CONNECT_RETRY_MIN
+            server.connect_timer = self.run_in(self.connect_zoneminder, 0, server=server.name)
+        self._stats_timer = self.run_in(self.log_stats, self.STATS_INTERVAL)
+        self._metrics_timer = self.run_in(self.publish_metrics,
+                                          self.metrics_opts.get('interval', self.METRICS_INTERVAL))
 
-        # at this point we should authenticated with zoneminder
         self.log('Zoneminder ES Handler init completed')
 
-    def clean_files_in_local_cache(self):
-        exp = self.img_cache_dir + "/*[.jpeg,.jpg]"
-        file_list = glob.glob(exp)
-        delete_cnt = 0
-        if len(file_list) > 0:
-            self.log("Cleaning cache dir: {} removing {} files ".format(self.img_cache_dir, len(file_list)))
-        for filePath in file_list:
-            fdelta = dt.now() - dt.fromtimestamp(os.stat(filePath).st_mtime)
-            age_of_file_in_secs = fdelta.total_seconds()
-            if age_of_file_in_secs > 30:
-                try:
-                    os.remove(filePath)
-                    delete_cnt += 1
-                except:
-                    pass
-        self.last_cleanup = dt.now()
-        return delete_cnt
+    def terminate(self):
+        """
+        terminate() function called by Appdaemon on shutdown and before a reload
+        """
+        for server in self.zm_servers.values():
+            if server.connect_timer is not None:
+                self.cancel_timer(server.connect_timer)
+                server.connect_timer = None
+            if server.audit_timer is not None:
+                self.cancel_timer(server.audit_timer)
+                server.audit_timer = None
+            if server.mqtt_source is not None:
+                server.mqtt_source.stop()
+                server.mqtt_source = None
+        if self._stats_timer is not None:
+            self.cancel_timer(self._stats_timer)
+            self._stats_timer = None
+        if self._metrics_timer is not None:
+            self.cancel_timer(self._metrics_timer)
+            self._metrics_timer = None
+        if self.coalescer is not None:
+            self.coalescer.cancel()
+        for server in self.zm_servers.values():
+            server.pool.stop()
+        # the alerts already gathered for a digest are sent rather than lost on a reload
+        for table in self.notify_tables.values():
+            if table.digest is not None:
+                table.digest.close()
+        if self._notify_fanout is not None:
+            self._notify_fanout.shutdown()
+            self._notify_fanout = None
+        if self.file_cache is not None:
+            self.file_cache.stop()
+        if self.state_store is not None:
+            self.state_store.close()
+            self.state_store = None
+        for server in self.zm_servers.values():
+            server.session.close()
+        self.zm_servers = {}
+
+    def runtime_state(self):
+        """
+        :return: dict of the state to be saved by the StateStore
+        """
+        state = {'sensors': {name: sensor.snapshot() for name, sensor in self.sensors.items()}}
+        if self.global_limiter is not None:
+            state['global_limiter'] = self.global_limiter.snapshot()
+        if self.frame_cache is not None:
+            state['frames'] = self.frame_cache.file_refs()
+        return state
+
+    def restore_runtime_state(self, state):
+        for name, sensor_state in state.get('sensors', {}).items():
+            if name in self.sensors:
+                self.sensors[name].restore(sensor_state)
+        if self.global_limiter is not None and 'global_limiter' in state:
+            self.global_limiter.restore(state['global_limiter'])
+        self.frame_cache.restore_file_refs(state.get('frames', []))
+
+    def mark_state_dirty(self):
+        if self.state_store is not None:
+            self.state_store.mark_dirty()
+
+    def make_server(self, name, server_cfg):
+        """
+        Build the session and worker pool of a zoneminder server, zm_session and workers
+        settings not given for the server are taken from the top level.
+        :param name: server name used by the sensors zm_monitor server setting
+        :param server_cfg: dict with zm_url, zmapi_loc, zm_user, zm_pw and optional settings
+        :return: ZmServer
+        """
+        zm_options = {
+            'apiurl': server_cfg["zm_url"] + server_cfg["zmapi_loc"],
+            'portalurl': server_cfg["zm_url"],
+            'user': server_cfg["zm_user"],
+            'password': server_cfg["zm_pw"],
+            'logger': ZmLogger(self.logger),  # use None if you don't want to log to ZM
+            'token': True if server_cfg.get("zmapi_use_token", True) else False
+        }
+        session_opts = server_cfg.get("zm_session", self.session_opts)
+        worker_opts = server_cfg.get("workers", self.worker_opts)
+        circuit_opts = session_opts.get('circuit', {})
+        breaker = CircuitBreaker(self.logger,
+                                 threshold=circuit_opts.get('threshold', CircuitBreaker.THRESHOLD),
+                                 backoff=circuit_opts.get('backoff', CircuitBreaker.BACKOFF),
+                                 max_backoff=circuit_opts.get('max_backoff', CircuitBreaker.MAX_BACKOFF))
+        session = ZmSession(self, zm_options, self.logger,
+                            pool_size=int(session_opts.get('pool_size', ZmSession.POOL_SIZE)),
+                            refresh_margin=session_opts.get('refresh_margin', ZmSession.REFRESH_MARGIN),
+                            refresh_check=session_opts.get('refresh_check', ZmSession.REFRESH_CHECK),
+                            breaker=breaker, timeout=session_opts.get('timeout', ZmSession.TIMEOUT),
+                            name='zm-admin' if name == ZmServer.DEFAULT else 'zm-admin-{}'.format(name))
+        pool = AlertWorkerPool(self.process_alert, self.logger,
+                               workers=int(worker_opts.get('count', 2)),
+                               queue_depth=int(worker_opts.get('queue_depth', 16)),
+                               overflow=worker_opts.get('overflow', 'drop_oldest'),
+                               block_timeout=worker_opts.get('block_timeout', 5),
+                               name='zm-alert' if name == ZmServer.DEFAULT else 'zm-alert-{}'.format(name),
+                               collapse_below=self.priority_opts.get('collapse_below'), metrics=self.metrics,
+                               metrics_name='queue' if name == ZmServer.DEFAULT else 'queue_{}'.format(name))
+        if name == ZmServer.DEFAULT and self.mqtt_opts is not None:
+            mqtt_topic = self.mqtt_opts.get('topic', MqttEventSource.TOPIC)
+        else:
+            mqtt_topic = server_cfg.get("mqtt_topic")
+        self.log("adding zoneminder server {}: {}".format(name, server_cfg["zm_url"]))
+        return ZmServer(name, session, pool, self.logger, session_opts=session_opts, mqtt_topic=mqtt_topic)
+
+    def connect_zoneminder(self, kwargs):
+        """
+        Timer callback, hands the connect of a zoneminder server to the admin thread of its session.
+        """
+        server = self.zm_servers.get(kwargs['server'])
+        if server is None:
+            return
+        server.connect_timer = None
+        server.session.submit(self.connect_server, server)
+
+    def schedule_connect(self, server):
+        server.connect_timer = self.run_in(self.connect_zoneminder, server.connect_retry, server=server.name)
+        server.connect_retry = min(server.connect_retry * 2,
+                                   server.session_opts.get('connect_retry_max', self.CONNECT_RETRY_MAX))
+
+    def connect_server(self, server):
+        """
+        Connects to a zoneminder server retrying with exponential backoff until it succeeds, runs on
+        the admin thread of the server's session.
+        Once connected the monitor list is fetched once, every sensor of the server is bound to its
+        monitor from that list and the initial monitor functions are pushed in parallel.
+        """
+        if server.api is None and not server.session.connect():
+            self.error("Failed to connect to Zoneminder server {}, retrying in {}s".format(server.name,
+                                                                                         server.connect_retry))
+            self.schedule_connect(server)
+            return
+        try:
+            version_info = server.api.version()
+            if version_info is not None and version_info['status'] == 'ok':
+                self.log("Connected to Zoneminder server {} reporting"
+                         " version {}".format(server.name, version_info['zm_version']))
+                self.log("API pyzm reporting version {}".format(version_info['api_version']))
+            else:
+                self.error("Failed to retrieve version info for Zoneminder server {}".format(server.name))
+        except Exception as e:
+            self.error('Error: {}'.format(str(e)))
+            self.error(traceback.format_exc())
+        monitors = server.session.call(lambda: server.api.monitors().list(), what='monitors')
+        if monitors is None:
+            self.error("Failed to get the monitors of Zoneminder server {}, retrying in {}s".format(
+                server.name, server.connect_retry))
+            self.schedule_connect(server)
+            return
+        self.bind_monitors(server, monitors)
+        self.schedule_audit(server)
+
+    def bind_monitors(self, server, monitors):
+        mo_by_name = {mo.name().lower(): mo for mo in monitors}
+        bindings = []
+        for sensor in server.sensors:
+            mo = mo_by_name.get(str(sensor.monitor_name).lower())
+            if mo is None:
+                self.error('Failed to find Zoneminder monitor: {} on server {} for sensor {}'.format(
+                    sensor.monitor_name, server.name, sensor.name))
+                continue
+            bindings.append((sensor, mo))
+        if not bindings:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(bindings), self.STARTUP_WORKERS)) as executor:
+            futures = [executor.submit(sensor.bind_monitor, mo, server.session) for sensor, mo in bindings]
+        server.sensors_by_monitor = {mo.id(): sensor for sensor, mo in bindings}
+        for (sensor, mo), future in zip(bindings, futures):
+            if future.exception() is not None:
+                self.error("Failed to set initial function of monitor {}: {}".format(mo.name(),
+                                                                                     future.exception()))
+        self.log("Bound {} sensors to zoneminder server {} monitors".format(len(bindings), server.name))
+
+    def schedule_audit(self, server):
+        interval = self.audit_opts.get('interval', self.AUDIT_INTERVAL)
+        jitter = self.audit_opts.get('jitter', self.AUDIT_JITTER)
+        server.audit_timer = self.run_in(self.audit_monitors, max(1, interval + random.uniform(-jitter, jitter)),
+                                         server=server.name)
+
+    def audit_monitors(self, kwargs):
+        """
+        Timer callback, hands the audit of a zoneminder server to the admin thread of its session.
+        """
+        server = self.zm_servers.get(kwargs['server'])
+        if server is None:
+            return
+        # make sure to start timer for next audit cycle
+        self.schedule_audit(server)
+        if server.audit_future is not None and not server.audit_future.done():
+            self.log("Audit of zoneminder server {} still running, cycle skipped".format(server.name))
+            return
+        server.audit_future = server.session.submit(self.audit_server, server)
+
+    def audit_server(self, server):
+        """
+        Periodic audit of all monitors of one zoneminder server, runs on the admin thread of its session.
+        One bulk monitors request per cycle is used to reconcile every ZmMonitor,
+        so the API load does not grow with the number of cameras.
+        """
+        with self.metrics.span(server.audit_metrics_name, 'fetch'):
+            monitors = server.session.call(lambda: server.api.monitors({'force_reload': True}).list(),
+                                           what='audit monitors')
+        if monitors is None:
+            self.log("Audit monitors request to zoneminder server {} failed".format(server.name))
+            return
+        mo_by_id = {mo.id(): mo for mo in monitors}
+        for sensor in server.sensors:
+            if sensor.monitor() is None:
+                continue
+            mo = mo_by_id.get(sensor.monitor_id())
+            if mo is None:
+                self.log("Audit: zoneminder did not report monitor {}".format(sensor.monitor().name))
+                continue
+            with self.metrics.span(sensor.name, 'audit'):
+                sensor.monitor().audit_monitor_state(mo)
+
+    def publish_metrics(self, kwargs):
+        """
+        Timer callback, publishes the stage latencies of each sensor as attributes of a
+        Home Assistant sensor (state is the p50 total alert time in ms), the alert queue of each
+        zoneminder server as a sensor (state is the queue depth) and optionally writes them to
+        a Prometheus text format file.
+        """
+        self._metrics_timer = self.run_in(self.publish_metrics,
+                                          self.metrics_opts.get('interval', self.METRICS_INTERVAL))
+        prefix = self.metrics_opts.get('sensor_prefix', 'sensor.zmnotify_latency_')
+        for name in self.metrics.names():
+            summary = self.metrics.summary(name)
+            state = summary.get('total', {}).get('p50_ms', 0)
+            attributes = {'unit_of_measurement': 'ms', 'friendly_name': 'zmnotify {} latency'.format(name)}
+            for stage, values in summary.items():
+                for key, value in values.items():
+                    attributes['{}_{}'.format(stage, key)] = value
+            self.set_state(prefix + name.split('.')[-1], state=state, attributes=attributes)
+        # alert queue depth (state) with the per priority depth, drop and collapse counts
+        queue_prefix = self.metrics_opts.get('queue_sensor_prefix', 'sensor.zmnotify_queue_')
+        queue_lines = ['# HELP zmnotify_queue_depth Alerts waiting per priority',
+                       '# TYPE zmnotify_queue_depth gauge',
+                       '# HELP zmnotify_queue_dropped_total Alerts dropped from a full queue per priority',
+                       '# TYPE zmnotify_queue_dropped_total counter']
+        for server in self.zm_servers.values():
+            stats = server.pool.stats()
+            attributes = {'friendly_name': 'zmnotify {} alert queue'.format(server.name),
+                          'submitted': stats['submitted'], 'processed': stats['processed'], 'failed': stats['failed']}
+            for counter in ('depth', 'dropped', 'collapsed'):
+                for priority, value in stats[counter].items():
+                    attributes['{}_p{}'.format(counter, priority)] = value
+            self.set_state(queue_prefix + server.name, state=server.pool.qsize(), attributes=attributes)
+            for priority, value in stats['depth'].items():
+                queue_lines.append('zmnotify_queue_depth{{server="{}",priority="{}"}} {}'.format(server.name,
+                                                                                                 priority, value))
+            for priority, value in stats['dropped'].items():
+                queue_lines.append('zmnotify_queue_dropped_total{{server="{}",priority="{}"}} {}'.format(
+                    server.name, priority, value))
+        prom_file = self.metrics_opts.get('prometheus_file')
+        if prom_file:
+            tmp_file = prom_file + '.part'
+            try:
+                with open(tmp_file, 'w') as f:
+                    f.write(self.metrics.prometheus_text())
+                    f.write('\n'.join(queue_lines) + '\n')
+                os.replace(tmp_file, prom_file)
+            except OSError as e:
+                self.log("Failed to write metrics file {}: {}".format(prom_file, str(e)))
+
+    def log_stats(self, kwargs):
+        self._stats_timer = self.run_in(self.log_stats, self.STATS_INTERVAL)
+        for server in self.zm_servers.values():
+            self.log("Zoneminder server {} session stats: {}".format(server.name, server.session.stats()))
+            self.log("Zoneminder server {} alert queue stats: {}".format(server.name, server.pool.stats()))
+        self.log("Frame cache stats: {}".format(self.frame_cache.stats()))
+        self.log("Image cache dir stats: {}".format(self.file_cache.stats()))
+        for sensor in self.sensors.values():
+            self.log("Sensor {} rate limit stats: {}".format(sensor.name, sensor.limiter().stats()))
+        if self.global_limiter is not None:
+            self.log("Global rate limit stats: {}".format(self.global_limiter.stats()))
+        if self.img_resizer is not None:
+            self.log("Image resize totals: {} bytes in, {} bytes out".format(self.img_resizer.bytes_in,
+                                                                            self.img_resizer.bytes_out))
 
     def get_fid(self, frame_code):
         fid_map = {'a': "alarm",
@@ -434,12 +2755,42 @@ class ZmEventNotifier(hass.Hass):
             self.log("invalid frame code {}".format(frame_code))
             raise TypeError
 
-    @staticmethod
-    def clean_text_msg(txt_msg, blk_list):
-        r_txt = txt_msg
-        for item in blk_list:
-            r_txt = r_txt.replace(item, '')
-        return r_txt
+    def cached_frame(self, key):
+        """
+        :return: cache key of the frame to send, the resized variant if cached, None on a miss
+        """
+        if self.img_resizer is not None:
+            resized_key = self.img_resizer.key(key)
+            if self.frame_cache.get(resized_key) is not None:
+                return resized_key
+        data = self.frame_cache.get(key)
+        if data is not None:
+            return self.resize_frame(key, data)
+        return None
+
+    def store_frame(self, zm_sensor, key, data):
+        """
+        Add a downloaded frame and its resized variant to the frame cache.
+        :return: cache key of the frame to send
+        """
+        self.frame_cache.put(key, data)
+        with self.metrics.span(zm_sensor.name, 'resize'):
+            return self.resize_frame(key, data)
+
+    def resize_frame(self, key, data):
+        """
+        Add the resized variant of a frame to the frame cache.
+        :return: cache key of the frame to send
+        """
+        if self.img_resizer is None:
+            return key
+        resized = self.img_resizer.resize(data)
+        if resized is None:
+            return key
+        resized_key = self.img_resizer.key(key)
+        self.frame_cache.put(resized_key, resized)
+        self.log("Resized image for event id:{} from {} to {} bytes".format(key[0], len(data), len(resized)))
+        return resized_key
 
     def handle_occupied_state_change(self, entity, attribute, old, new, kwargs):
         self.log('processing state change for entity: {} to state {}'.format(entity, new))
@@ -448,17 +2799,16 @@ class ZmEventNotifier(hass.Hass):
         else:
             occupied = False
         self.occupied_state = occupied
-        if occupied:
-            self.notify_list = self.notify_occup_list
-            self.log("Setting to {} notify list, len={}".format("occupied", len(self.notify_list)))
-        else:
-            self.notify_list = self.notify_unoccup_list
-            self.log("Setting to {} notify list, len={}".format("unoccupied", len(self.notify_list)))
+        self.notify_table = self.notify_tables[occupied]
+        self.log("Setting to {} notify list, len={}".format(self.notify_table.name, len(self.notify_table)))
 
 
     def handle_state_change(self, entity, attribute, old, new, kwargs):
         """
         generate notifications for camera motion
+        The state is parsed here and held by the event coalescer, once the coalescing window
+        for the event closes it is queued to the alert worker pool where the zoneminder
+        lookups and notifications are done by process_alert.
         new state string from zoneminder will be formatted as
           "driveway hires:(503) [a] detected:car:78% Linked"
            camera-name:(event-id) [frame-type] "object detect message"
@@ -471,82 +2821,180 @@ class ZmEventNotifier(hass.Hass):
         """
         # is the notify gate on for the camera reporting object detection?
         zm_sensor: HASensor = self.sensors[entity]
-        if not zm_sensor.squelched():
-            zm_sensor.process_event()
-
         if self.get_state(zm_sensor.ha_gate) == 'on':
             if not zm_sensor.squelched():
                 self.log('processing state change for entity: {}'.format(entity))
                 # gate is on, so proceed with notifications
-                timestamp = dt.now().strftime(self.__class__.ts_fmt)
-                camera, detail = new.split(':(')
-                event_id, sub_detail = detail.split(') ')
-                frame, txt_body = sub_detail.split('] ')
-                txt_body = self.clean_text_msg(txt_body, self.txt_blk_list)
-                msg_title = '{} Camera alert @{}\n'.format(camera, timestamp)
-                fid = frame[1:]
-                zm_event: zmtypes.Event = zm_sensor.monitor().find_event(event_id)
-                if zm_event is not None:
-                    self.log("found ZM Event ({}) for id {}".format(zm_event.name(), zm_event.id()))
-                else:
-                    self.error("failed to find ZM Event for id {}, aborting".format(event_id))
+                with self.metrics.span(entity, 'parse'):
+                    record = self.state_parser.parse(new)
+                    if record is not None:
+                        record.text = self.txt_blocklist.clean(record.text)
+                if record is None:
+                    self.log("ZM ES Handler: ignoring malformed state from {}: {} (rejected cnt: {})".format(
+                        entity, new, self.state_parser.rejected))
                     return
-                # attempt to pull the image based on the configured frame type
-                # but if not available, pull the type indicated in the name/msg field
-                ftl = [self.img_frame_type, fid]
-                ft_min_set = [i for n, i in enumerate(ftl) if i not in ftl[:n]]
-
-                attempt = 1
-                for entry in ft_min_set:
-                    self.log("Attempt #({}): pull image file with fid: {}".format(attempt, entry))
-                    frame_type = self.get_fid(entry)
-                    zm_event.download_image(fid=frame_type, dir=self.img_cache_dir)
-                    img_filename = "{}-{}.jpg".format(zm_event.id(), frame_type)
-                    img_file_uri = os.path.join(self.img_cache_dir, img_filename)
-                    self.cache_file_cnt += 1
-                    if os.path.exists(img_file_uri):
-                        for notifier in self.notify_list:
-                            nlist = notifier.split(',')
-                            notify_path = nlist[0]
-                            notify_entity = None
-                            if len(nlist) > 1:
-                                notify_entity = nlist[1]
-                            try:
-                                if notify_path.startswith('notify/'):
-                                    self.log(
-                                        "ZM ES Handler: sending text to {} for event: {}".format(notify_path, event_id))
-                                    # currently relying on a hint embedded in the name of the notify path
-                                    if "hangout" in notify_path:
-                                        self.call_service(notify_path, message=txt_body, title=msg_title,
-                                                          data={'image_file': img_file_uri})
-                                    else:
-                                        # fall through to here with a simple call to send text with an image
-                                        # need to explore if these entities can be queried on type to descriminate
-                                        # how to make the service call
-                                        msg_txt = msg_title + txt_body
-                                        self.call_service(notify_path, message=msg_txt)
-                                elif notify_path.startswith('tts/') and notify_entity is not None:
-                                    self.log("ZM ES Handler: announcing text via tts to {} for event: {}".format(
-                                        notify_entity, event_id))
-                                    info_txt = txt_body.split(':')
-                                    announce_text = "{} camera {}".format(camera, " ".join(info_txt))
-                                    self.call_service(notify_path, entity_id=notify_entity, message=announce_text)
-                                else:
-                                    self.log("Dropping notification to {}".format(notify_path))
-                            except:
-                                self.log("Exception encountered on calling entity {}".format(notify_path))
-                                pass
-                        break
-                    else:
-                        self.log("Failed to pull Zoneminder image for event id:{} camera: {} msg: {}".format(event_id,
-                                                                                                             camera,
-                                                                                                             txt_body))
-                        attempt += 1
-                cleanup_delta = dt.now() - self.last_cleanup
-                if cleanup_delta.total_seconds() >= self.CLEANUP_INTERVAL:
-                    self.cache_file_cnt -= self.clean_files_in_local_cache()
+                self.coalescer.submit(zm_sensor, record)
             else:
                 self.log("ZM ES Handler: squelch active for entity: {}".format(entity))
         else:
             self.log("ZM ES Handler: notify gate is turned off for entity: {}".format(entity))
         return
+
+    def handle_mqtt_event(self, topic, payload, server=None):
+        """
+        Alternative input to handle_state_change, the zoneminder ES MQTT payload carries the
+        event id, monitor id and detections so the image can be pulled without an event lookup.
+        :param topic: MQTT topic e.g. zoneminder/1
+        :param payload: JSON payload published by zoneminder ES
+        :param server: ZmServer whose zoneminder ES publishes on the topic
+        """
+        with self.metrics.span('mqtt', 'parse'):
+            record = self.state_parser.parse_mqtt(payload)
+        if record is None:
+            self.log("ZM ES Handler: ignoring malformed MQTT payload on {} (rejected cnt: {})".format(
+                topic, self.state_parser.rejected))
+            return
+        if record.event_type not in self.mqtt_opts.get('event_types', ['event_start']):
+            return
+        zm_sensor = server.sensors_by_monitor.get(record.monitor_id)
+        if zm_sensor is None:
+            self.log("ZM ES Handler: no sensor bound to zoneminder monitor {} ({})".format(record.monitor_id, topic))
+            return
+        if self.get_state(zm_sensor.ha_gate) != 'on':
+            self.log("ZM ES Handler: notify gate is turned off for {}".format(zm_sensor.name))
+            return
+        if zm_sensor.squelched():
+            self.log("ZM ES Handler: squelch active for {}".format(zm_sensor.name))
+            return
+        record.text = self.txt_blocklist.clean(record.text)
+        self.coalescer.submit(zm_sensor, record)
+
+    def queue_alert(self, zm_sensor, record):
+        """
+        Called once per event when its coalescing window closes, applies the sensor rate limit
+        and hands the alert to the worker pool.
+        """
+        if zm_sensor.monitor() is None:
+            self.log("ZM ES Handler: {} not yet bound to a zoneminder monitor, dropped event {}".format(
+                zm_sensor.name, record.event_id))
+            return
+        self.mark_state_dirty()
+        if not zm_sensor.process_event():
+            self.log("ZM ES Handler: squelch active for {}, dropped event {}".format(zm_sensor.name,
+                                                                                    record.event_id))
+            return
+        if self.global_limiter is not None and not self.global_limiter.allow():
+            self.log("ZM ES Handler: global rate limit reached, dropped event {} for {} "
+                     "(suppressed cnt: {})".format(record.event_id, zm_sensor.name, self.global_limiter.suppressed))
+            return
+        priority = self.alert_priority.classify(record)
+        if not self.zm_servers[zm_sensor.server].pool.submit((zm_sensor, record), priority=priority,
+                                                             key=zm_sensor.name):
+            self.log("ZM ES Handler: alert queue full, dropped event {} for {} (priority {})".format(
+                record.event_id, zm_sensor.name, priority))
+
+    def process_alert(self, zm_sensor, record):
+        """
+        Worker side of handle_state_change, runs on an AlertWorkerPool thread.
+        Resolves the zoneminder event, pulls the image frame and sends the notifications.
+        :param zm_sensor: HASensor reporting the event
+        :param record: ZmEventRecord parsed from the sensor state, text already cleaned
+        """
+        camera = record.camera
+        event_id = record.event_id
+        fid = record.frame_code
+        txt_body = record.text
+        timestamp = dt.fromtimestamp(record.received).strftime(self.__class__.ts_fmt)
+        msg_title = '{} Camera alert @{}\n'.format(camera, timestamp)
+        # attempt to pull the image based on the configured frame type
+        # but if not available, pull the type indicated in the name/msg field
+        ftl = [self.img_frame_type, fid]
+        ft_min_set = [i for n, i in enumerate(ftl) if i not in ftl[:n]]
+
+        server = self.zm_servers[zm_sensor.server]
+        session = server.session
+        session.reset_shed()
+        keys = [(server.frame_id(event_id), self.get_fid(entry)) for entry in ft_min_set]
+        frame_key = None
+        for key in keys:
+            with self.metrics.span(zm_sensor.name, 'frame_cache'):
+                frame_key = self.cached_frame(key)
+            if frame_key is not None:
+                self.log("Using cached image for event id:{} fid: {}".format(event_id, key[1]))
+                break
+        if frame_key is None:
+            # fast path, the frame straight from the image view by event id without an event lookup
+            for key in keys:
+                if session.breaker.is_open():
+                    break
+                with self.metrics.span(zm_sensor.name, 'download'):
+                    data = session.fetch_frame(event_id, key[1], max_bytes=self.frame_cache.max_bytes)
+                if data:
+                    frame_key = self.store_frame(zm_sensor, key, data)
+                    break
+                if session.was_shed():
+                    break
+        if frame_key is None and not (session.was_shed() or session.breaker.is_open()):
+            # fall back to resolving the event, also tries the frame with the highest score
+            with self.metrics.span(zm_sensor.name, 'find_event'):
+                zm_event: zmtypes.Event = zm_sensor.monitor().find_event(event_id)
+            if zm_event is None:
+                if not (session.was_shed() or session.breaker.is_open()):
+                    self.error("failed to find ZM Event for id {}, aborting".format(event_id))
+                    return
+            else:
+                self.log("found ZM Event ({}) for id {}".format(zm_event.name(), zm_event.id()))
+                # the frame types were already tried by the direct fetch, only the frame with the
+                # highest score is new
+                max_score_fid = zm_event.get().get('MaxScoreFrameId')
+                key = (server.frame_id(event_id), str(max_score_fid)) if max_score_fid else None
+                if key is not None and key not in keys:
+                    with self.metrics.span(zm_sensor.name, 'frame_cache'):
+                        frame_key = self.cached_frame(key)
+                    if frame_key is None:
+                        self.log("Pull image file with fid: {}".format(key[1]))
+                        with self.metrics.span(zm_sensor.name, 'download'):
+                            data = session.fetch_image(zm_event, key[1], max_bytes=self.frame_cache.max_bytes)
+                        if data:
+                            frame_key = self.store_frame(zm_sensor, key, data)
+                if frame_key is None:
+                    self.log("Failed to pull Zoneminder image for event id:{} camera: {} msg: {}".format(
+                        event_id, camera, txt_body))
+        # requests shed by the circuit breaker, zoneminder is down
+        unavailable = frame_key is None and (session.was_shed() or session.breaker.is_open())
+        notify_table = self.notify_table
+        routes = notify_table.routes(camera, record.labels)
+        if notify_table.digest is not None and (frame_key is not None or unavailable):
+            notify_table.digest.add(routes, record, frame_key)
+            self.metrics.record(zm_sensor.name, 'total', time.time() - record.received)
+            return
+        calls = []
+        if frame_key is not None:
+            img_file_uri = None
+            if any(d.wants_image for d in routes):
+                img_file_uri = self.frame_cache.path(frame_key)
+            for dispatcher in routes:
+                self.log("ZM ES Handler: sending to {} for event: {}".format(dispatcher.service, event_id))
+                calls.append((dispatcher.service, dispatcher.payload(camera, msg_title, txt_body, img_file_uri)))
+            self.mark_state_dirty()
+        elif unavailable:
+            # zoneminder is down, don't hold the alert back waiting for an image
+            self.log("ZM ES Handler: zoneminder unavailable, sending text only for event: {}".format(event_id))
+            for dispatcher in routes:
+                calls.append((dispatcher.service, dispatcher.text_payload(camera, msg_title, txt_body)))
+        if calls:
+            with self.metrics.span(zm_sensor.name, 'notify'):
+                self.send_notifications(calls, 'event {}'.format(event_id))
+            self.metrics.record(zm_sensor.name, 'total', time.time() - record.received)
+
+    def send_notifications(self, calls, what):
+        """
+        Send the notify service calls concurrently and log the ones that failed.
+        :param calls: list of (service, kwargs)
+        :param what: description of the alert for the log
+        """
+        results = self._notify_fanout.dispatch(calls)
+        for result in results:
+            if result.status != NotifyFanout.OK:
+                self.log("Notification to {} for {} failed ({}) after {} attempt(s): {}".format(
+                    result.target, what, result.status, result.attempts, result.error))